@@ -2,8 +2,11 @@
 AIエンジン - OpenAI APIを使用した応答生成
 """
 import os
+import logging
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple
+import httpx
 from openai import AsyncOpenAI
 from datetime import datetime
 
@@ -12,17 +15,147 @@ from app.models import (
     PersonaType, ConversationStatus, SuccessCase, FAQ
 )
 from app.knowledge_base import knowledge_base
+from app.keyword_matcher import KeywordMatcher
 from app.persona_analyzer import persona_analyzer
 
+logger = logging.getLogger(__name__)
+
+# ナレッジ検索用のキーワード（この順序で抽出結果を返す）
+KEYWORD_PATTERNS = (
+    "初心者", "料金", "費用", "時間", "仕事", "育児", "副業",
+    "稼", "収益", "フォロワー", "ジャンル", "サポート", "講師",
+    "勉強会", "個別相談", "料理", "ダイエット", "美容",
+    "不安", "大丈夫", "できる", "分割", "支払い"
+)
+_KEYWORD_MATCHER = KeywordMatcher({pattern: i for i, pattern in enumerate(KEYWORD_PATTERNS)})
+
+# 質問らしさを判定する語（疑問符を含む）
+QUESTION_WORDS = ("?", "？", "ですか", "ますか", "どう", "いくら", "何")
+_QUESTION_MATCHER = KeywordMatcher({word: True for word in QUESTION_WORDS})
+
+# ストリーミング応答をセグメントに区切る文末・改行
+SEGMENT_ENDINGS = ("。", "！", "？", "!", "?", "\n")
+
+# OpenAI APIの呼び出しに失敗したときの応答
+ERROR_RESPONSE = "申し訳ありません、一時的に応答ができない状態です。少し時間をおいてから再度メッセージをお送りください🙏"
+
+
+@lru_cache(maxsize=1024)
+def _render_context_prompt(
+    display_name: Optional[str],
+    occupation: Optional[str],
+    interest_genre: Tuple[str, ...],
+    challenges: Tuple[str, ...],
+    goals: Optional[str],
+    persona_value: str,
+    status_value: str,
+    mentioned_cases: Tuple[str, ...]
+) -> str:
+    """顧客コンテキストのプロンプト文字列を生成"""
+    # 顧客情報のサマリー
+    customer_info = []
+    if display_name:
+        customer_info.append(f"お名前: {display_name}さん")
+    if occupation:
+        customer_info.append(f"職業: {occupation}")
+    if interest_genre:
+        customer_info.append(f"興味ジャンル: {', '.join(interest_genre)}")
+    if challenges:
+        customer_info.append(f"課題: {', '.join(challenges)}")
+    if goals:
+        customer_info.append(f"目標: {goals}")
+    
+    if persona_value != "未特定":
+        customer_info.append(f"推定ペルソナ: {persona_value}")
+    
+    customer_info.append(f"ステータス: {status_value}")
+    
+    context_prompt = f"""
+## 現在の顧客情報
+{chr(10).join(customer_info) if customer_info else "（まだヒアリング前です）"}
+
+## 対話の指針
+- この顧客に合わせた対話を心がけてください
+- まだ情報が少ない場合は、自然な形でヒアリングを進めてください
+- 既に言及した成功事例: {', '.join(mentioned_cases) if mentioned_cases else 'なし'}
+"""
+    return context_prompt
+
 
 class AIEngine:
     """AI応答生成エンジン"""
     
-    def __init__(self, api_key: str, model: str = "gpt-4-turbo-preview"):
-        self.client = AsyncOpenAI(api_key=api_key)
+    # OpenAI APIへのコネクションプール設定
+    MAX_CONNECTIONS = 100
+    MAX_KEEPALIVE_CONNECTIONS = 64
+    
+    # 会話の要約設定：要約されていないメッセージがSUMMARY_INTERVAL件たまったら、
+    # 直近SUMMARY_KEEP_MESSAGES件を残してそれより前を要約に畳み込む
+    SUMMARY_INTERVAL = 8
+    SUMMARY_KEEP_MESSAGES = 2
+    SUMMARY_MAX_TOKENS = 300
+    
+    # ストリーミング応答で最初に返信するセグメントの最低文字数
+    STREAM_SEGMENT_MIN_CHARS = 60
+    
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gpt-4-turbo-preview",
+        embedding_model: Optional[str] = None
+    ):
+        # 同時に届いたWebhookでもTCP/TLS接続を使い回せるよう、
+        # HTTP/2 + keep-aliveのクライアントを共有する
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=self.MAX_CONNECTIONS,
+                max_keepalive_connections=self.MAX_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client)
         self.model = model
+        # 指定時のみナレッジの意味検索を行う
+        self.embedding_model = embedding_model
         self.system_prompt = self._load_system_prompt()
     
+    async def aclose(self):
+        """HTTPクライアントを閉じる"""
+        await self.client.close()
+    
+    async def prepare_knowledge_embeddings(self):
+        """ナレッジの埋め込みを用意（キャッシュに無いテキストのみAPIで計算）"""
+        if not self.embedding_model:
+            return
+        
+        vectors = knowledge_base.load_embedding_cache(self.embedding_model)
+        missing = [text for text in knowledge_base.embedding_texts() if text not in vectors]
+        if missing:
+            response = await self.client.embeddings.create(
+                model=self.embedding_model,
+                input=missing
+            )
+            for text, item in zip(missing, response.data):
+                vectors[text] = item.embedding
+        
+        knowledge_base.set_embeddings(self.embedding_model, vectors)
+    
+    async def _embed_query(self, text: str) -> Optional[List[float]]:
+        """ユーザーメッセージの埋め込みを取得（失敗時はNone）"""
+        if not self.embedding_model or not knowledge_base.has_embeddings:
+            return None
+        
+        try:
+            response = await self.client.embeddings.create(
+                model=self.embedding_model,
+                input=[text]
+            )
+            return response.data[0].embedding
+        except Exception as e:
+            logger.warning(f"Embedding request failed, falling back to keyword search: {e}")
+            return None
+    
     def _load_system_prompt(self) -> str:
         """システムプロンプトを読み込み"""
         prompt_path = Path("prompts/system_prompt.txt")
@@ -40,58 +173,49 @@ class AIEngine:
     def _build_context_prompt(self, context: ConversationContext) -> str:
         """顧客コンテキストを含むプロンプトを構築"""
         customer = context.customer
-        
-        # 顧客情報のサマリー
-        customer_info = []
-        if customer.display_name:
-            customer_info.append(f"お名前: {customer.display_name}さん")
-        if customer.occupation:
-            customer_info.append(f"職業: {customer.occupation}")
-        if customer.interest_genre:
-            customer_info.append(f"興味ジャンル: {', '.join(customer.interest_genre)}")
-        if customer.challenges:
-            customer_info.append(f"課題: {', '.join(customer.challenges)}")
-        if customer.goals:
-            customer_info.append(f"目標: {customer.goals}")
-        
-        persona_value = customer.persona if isinstance(customer.persona, str) else customer.persona.value
-        if persona_value != "未特定":
-            customer_info.append(f"推定ペルソナ: {persona_value}")
-        
+        persona_value = customer.persona_str
         status_value = customer.status if isinstance(customer.status, str) else customer.status.value
-        customer_info.append(f"ステータス: {status_value}")
         
-        context_prompt = f"""
-## 現在の顧客情報
-{chr(10).join(customer_info) if customer_info else "（まだヒアリング前です）"}
-
-## 対話の指針
-- この顧客に合わせた対話を心がけてください
-- まだ情報が少ない場合は、自然な形でヒアリングを進めてください
-- 既に言及した成功事例: {', '.join(context.mentioned_cases) if context.mentioned_cases else 'なし'}
-"""
-        return context_prompt
+        # 顧客情報が変わらない限り同じ文字列を再利用する
+        return _render_context_prompt(
+            customer.display_name,
+            customer.occupation,
+            tuple(sorted(customer.interest_genre)),
+            tuple(sorted(customer.challenges)),
+            customer.goals,
+            persona_value,
+            status_value,
+            tuple(context.mentioned_cases)
+        )
     
     def _get_relevant_knowledge(
         self, 
         context: ConversationContext,
-        user_message: str
+        user_message: str,
+        query_embedding: Optional[List[float]] = None,
+        keywords: Optional[List[str]] = None
     ) -> str:
-        """関連するナレッジを取得"""
+        """関連するナレッジを取得（keywordsは抽出済みの場合に渡す）"""
         customer = context.customer
         knowledge_parts = []
         
         # キーワード抽出
-        keywords = self._extract_keywords(user_message)
+        if keywords is None:
+            keywords = self._extract_keywords(user_message)
+        persona_value = customer.persona_str
+        
+        # 手がかりが何もなければ検索しない（「はい」などの相槌）
+        if not self._has_search_clues(customer, keywords):
+            return ""
         
         # 成功事例の検索
-        persona_value = customer.persona if isinstance(customer.persona, str) else customer.persona.value
         cases = knowledge_base.search_success_cases(
             persona=persona_value if persona_value != "未特定" else None,
             challenges=customer.challenges,
             keywords=keywords,
             exclude_ids=context.mentioned_cases,
-            limit=2
+            limit=2,
+            query_embedding=query_embedding
         )
         
         if cases:
@@ -108,10 +232,13 @@ class AIEngine:
 """)
         
         # FAQの検索（質問っぽい内容の場合）
-        if "?" in user_message or "？" in user_message or any(
-            word in user_message for word in ["ですか", "ますか", "どう", "いくら", "何"]
-        ):
-            faqs = knowledge_base.search_faqs(keywords=keywords, limit=2)
+        # 「?」だけでキーワードも埋め込みも無いときは弱いスコアのノイズになるため除く
+        if (keywords or query_embedding is not None) and _QUESTION_MATCHER.search(user_message):
+            faqs = knowledge_base.search_faqs(
+                keywords=keywords,
+                limit=2,
+                query_embedding=query_embedding
+            )
             if faqs:
                 knowledge_parts.append("## 関連するFAQ")
                 for faq in faqs:
@@ -122,23 +249,16 @@ A: {faq.answer}
         
         return "\n".join(knowledge_parts) if knowledge_parts else ""
     
+    @staticmethod
+    def _has_search_clues(customer: Customer, keywords: List[str]) -> bool:
+        """ナレッジ検索の手がかり（キーワード・課題・ペルソナ）があるか"""
+        return bool(keywords or customer.challenges or customer.persona_str != "未特定")
+    
     def _extract_keywords(self, message: str) -> List[str]:
         """メッセージからキーワードを抽出"""
-        # 簡易的なキーワード抽出
-        keywords = []
-        
-        keyword_patterns = [
-            "初心者", "料金", "費用", "時間", "仕事", "育児", "副業",
-            "稼", "収益", "フォロワー", "ジャンル", "サポート", "講師",
-            "勉強会", "個別相談", "料理", "ダイエット", "美容",
-            "不安", "大丈夫", "できる", "分割", "支払い"
-        ]
-        
-        for pattern in keyword_patterns:
-            if pattern in message:
-                keywords.append(pattern)
-        
-        return keywords
+        # 1回の走査で全パターンを検出し、パターン定義順で返す
+        found = set(_KEYWORD_MATCHER.iter(message))
+        return [KEYWORD_PATTERNS[i] for i in sorted(found)]
     
     def _build_messages(
         self,
@@ -146,21 +266,42 @@ A: {faq.answer}
         user_message: str,
         knowledge: str
     ) -> List[Dict[str, str]]:
-        """API用のメッセージリストを構築"""
+        """
+        API用のメッセージリストを構築
+        
+        OpenAIのプロンプトキャッシュは先頭一致でのみ効くため、
+        不変のシステムプロンプトを先頭に置き、顧客情報・ナレッジなど
+        ターンごとに変わる内容は後続のsystemメッセージに分ける
+        """
         messages = []
         
-        # システムプロンプト + コンテキスト + ナレッジ
-        full_system_prompt = self.system_prompt
-        full_system_prompt += "\n\n" + self._build_context_prompt(context)
-        if knowledge:
-            full_system_prompt += "\n\n" + knowledge
+        # 固定のシステムプロンプト（全顧客・全ターン共通）
+        messages.append({
+            "role": "system",
+            "content": self.system_prompt
+        })
         
+        # 顧客ごとのコンテキスト
         messages.append({
             "role": "system",
-            "content": full_system_prompt
+            "content": self._build_context_prompt(context)
         })
         
-        # 会話履歴（直近のメッセージ）
+        # これまでの会話の要約（更新は数ターンに1回なので、毎ターン変わるナレッジより前に置く）
+        if context.summary:
+            messages.append({
+                "role": "system",
+                "content": f"## これまでの会話の要約\n{context.summary}"
+            })
+        
+        # 関連ナレッジ（空の場合はメッセージ自体を送らない）
+        if knowledge:
+            messages.append({
+                "role": "system",
+                "content": knowledge
+            })
+        
+        # 会話履歴（要約に含まれていない直近のメッセージ）
         for msg in context.messages[-10:]:  # 直近10件
             messages.append({
                 "role": msg.role,
@@ -175,23 +316,35 @@ A: {faq.answer}
         
         return messages
     
-    async def generate_response(
+    async def _prepare_messages(
         self,
         context: ConversationContext,
         user_message: str
-    ) -> str:
-        """応答を生成"""
+    ) -> List[Dict[str, str]]:
+        """顧客プロファイルを更新し、API用のメッセージリストを用意"""
         # 顧客プロファイルを更新
         context.customer = persona_analyzer.analyze_message(
             user_message, 
             context.customer
         )
         
-        # 関連ナレッジを取得
-        knowledge = self._get_relevant_knowledge(context, user_message)
+        # 関連ナレッジを取得（手がかりがあり、意味検索が有効な場合のみメッセージを埋め込む）
+        keywords = self._extract_keywords(user_message)
+        query_embedding = None
+        if self._has_search_clues(context.customer, keywords):
+            query_embedding = await self._embed_query(user_message)
+        knowledge = self._get_relevant_knowledge(context, user_message, query_embedding, keywords)
         
         # メッセージを構築
-        messages = self._build_messages(context, user_message, knowledge)
+        return self._build_messages(context, user_message, knowledge)
+    
+    async def generate_response(
+        self,
+        context: ConversationContext,
+        user_message: str
+    ) -> str:
+        """応答を生成"""
+        messages = await self._prepare_messages(context, user_message)
         
         # OpenAI APIを呼び出し
         try:
@@ -205,8 +358,78 @@ A: {faq.answer}
             return response.choices[0].message.content
             
         except Exception as e:
-            print(f"OpenAI API error: {e}")
-            return "申し訳ありません、一時的に応答ができない状態です。少し時間をおいてから再度メッセージをお送りください🙏"
+            logger.error("OpenAI API error: %s", e)
+            return ERROR_RESPONSE
+    
+    async def generate_response_stream(
+        self,
+        context: ConversationContext,
+        user_message: str
+    ) -> AsyncIterator[str]:
+        """
+        応答をストリーミングで生成し、区切りのよい単位で順に返す
+        
+        STREAM_SEGMENT_MIN_CHARS文字以上たまり、文末・改行で終わった時点で
+        それまでのテキストを1つのセグメントとして返す（残りは最後に返す）
+        """
+        messages = await self._prepare_messages(context, user_message)
+        
+        buffer = ""
+        produced = False
+        try:
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=500,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                buffer += chunk.choices[0].delta.content or ""
+                if len(buffer) >= self.STREAM_SEGMENT_MIN_CHARS and buffer.endswith(SEGMENT_ENDINGS):
+                    produced = True
+                    yield buffer
+                    buffer = ""
+        except Exception as e:
+            logger.error("OpenAI API error: %s", e)
+            if not produced and not buffer:
+                buffer = ERROR_RESPONSE
+        
+        if buffer:
+            yield buffer
+    
+    def needs_summary(self, messages: List[Message]) -> bool:
+        """要約されていないメッセージが要約の更新に十分たまったか"""
+        return len(messages) >= self.SUMMARY_INTERVAL
+    
+    async def summarize_conversation(
+        self,
+        summary: Optional[str],
+        messages: List[Message]
+    ) -> str:
+        """これまでの要約に新しいメッセージを反映した要約を生成"""
+        transcript = "\n".join(
+            f"{'顧客' if msg.role == 'user' else 'アシスタント'}: {msg.content}"
+            for msg in messages
+        )
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "LINEでの顧客との会話を、以降の対応に必要な事実（顧客の状況・悩み・希望・案内済みの内容）を中心に日本語で簡潔に要約してください。"
+                },
+                {
+                    "role": "user",
+                    "content": f"## これまでの要約\n{summary or 'なし'}\n\n## 新しい会話\n{transcript}"
+                }
+            ],
+            temperature=0.3,
+            max_tokens=self.SUMMARY_MAX_TOKENS
+        )
+        return response.choices[0].message.content
     
     async def generate_welcome_message(self, customer: Customer) -> str:
         """ウェルカムメッセージを生成"""
@@ -223,8 +446,12 @@ A: {faq.answer}
 ai_engine: Optional[AIEngine] = None
 
 
-def initialize_ai_engine(api_key: str, model: str = "gpt-4-turbo-preview"):
+def initialize_ai_engine(
+    api_key: str,
+    model: str = "gpt-4-turbo-preview",
+    embedding_model: Optional[str] = None
+):
     """AIエンジンを初期化"""
     global ai_engine
-    ai_engine = AIEngine(api_key=api_key, model=model)
+    ai_engine = AIEngine(api_key=api_key, model=model, embedding_model=embedding_model)
     return ai_engine
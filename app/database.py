@@ -1,26 +1,176 @@
 """
 データベース管理
 """
-import json
+import asyncio
+import logging
 import os
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable
 from pathlib import Path
 import aiosqlite
+import orjson
 
 from app.models import Customer, Message, ConversationContext, PersonaType, ConversationStatus
 
+logger = logging.getLogger(__name__)
+
+
+# 興味ジャンル・課題はユーザー間・保存間で同じ組み合わせが繰り返し現れるため、
+# JSONのエンコード/デコード結果をキャッシュする
+@lru_cache(maxsize=1024)
+def _encode_json_list(values: Tuple[str, ...]) -> str:
+    """文字列リストをJSON文字列に変換（日本語はエスケープせずUTF-8のまま）"""
+    return orjson.dumps(values).decode("utf-8")
+
+
+@lru_cache(maxsize=1024)
+def _decode_json_list(raw: str) -> Tuple[str, ...]:
+    """JSON文字列を文字列タプルに変換"""
+    return tuple(orjson.loads(raw) or ())
+
 
 class Database:
     """SQLiteベースのデータベース管理クラス"""
     
+    # バックグラウンド書き込みのワーカー数（同じユーザーの書き込みは同じワーカーが順に処理する）
+    WRITE_WORKERS = 8
+    
+    # 読み込み専用コネクションの数（WALモードでは書き込み中も並行して読める）
+    READ_CONNECTIONS = 4
+    
+    # コネクションごとの読み込み設定（256MBまでmmapで読み、ページキャッシュは64MB）
+    CONNECTION_PRAGMAS = (
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-65536",
+    )
+    
     def __init__(self, db_path: str = "data/database.db"):
         self.db_path = db_path
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        
+        # 呼び出しごとに接続を開かず、書き込み用の1本のコネクションを使い回す
+        self._connection: Optional[aiosqlite.Connection] = None
+        # 読み込みは専用のコネクションに順番に振り分ける
+        self._read_connections: List[aiosqlite.Connection] = []
+        self._next_read = 0
+        self._connect_lock = asyncio.Lock()
+        # 書き込み（execute + commit）の直列化
+        self._write_lock = asyncio.Lock()
+        
+        # 応答を待たせないための書き込みキュー（ワーカーごとに1本）
+        self._write_queues: List[asyncio.Queue] = []
+        self._write_workers: List[asyncio.Task] = []
+        # ユーザーごとの未完了の書き込み数と、それが0になったことを知らせるイベント
+        self._pending_writes: Dict[str, int] = {}
+        self._writes_done: Dict[str, asyncio.Event] = {}
+    
+    async def _conn(self) -> aiosqlite.Connection:
+        """共有コネクションを取得（未接続なら接続する）"""
+        if self._connection is None:
+            async with self._connect_lock:
+                if self._connection is None:
+                    connection = await aiosqlite.connect(self.db_path)
+                    connection.row_factory = aiosqlite.Row
+                    await connection.execute("PRAGMA journal_mode=WAL")
+                    await connection.execute("PRAGMA synchronous=NORMAL")
+                    for pragma in self.CONNECTION_PRAGMAS:
+                        await connection.execute(pragma)
+                    self._connection = connection
+        return self._connection
+    
+    async def _read_conn(self) -> aiosqlite.Connection:
+        """読み込み用コネクションを取得（未接続なら接続する）"""
+        if not self._read_connections:
+            # WALモードの設定を済ませてから開く
+            await self._conn()
+            async with self._connect_lock:
+                if not self._read_connections:
+                    connections = []
+                    for _ in range(self.READ_CONNECTIONS):
+                        connection = await aiosqlite.connect(self.db_path)
+                        connection.row_factory = aiosqlite.Row
+                        await connection.execute("PRAGMA query_only=1")
+                        for pragma in self.CONNECTION_PRAGMAS:
+                            await connection.execute(pragma)
+                        connections.append(connection)
+                    self._read_connections = connections
+        connection = self._read_connections[self._next_read % len(self._read_connections)]
+        self._next_read += 1
+        return connection
+    
+    async def close(self):
+        """キューに残った書き込みを済ませてから共有コネクションを閉じる"""
+        if self._write_workers:
+            await asyncio.gather(*(queue.join() for queue in self._write_queues))
+            for worker in self._write_workers:
+                worker.cancel()
+            await asyncio.gather(*self._write_workers, return_exceptions=True)
+            self._write_queues = []
+            self._write_workers = []
+        for connection in self._read_connections:
+            await connection.close()
+        self._read_connections = []
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+    
+    def submit_write(
+        self,
+        user_id: str,
+        write: Callable[..., Awaitable[Any]],
+        *args: Any
+    ):
+        """
+        書き込みをバックグラウンドで実行する（完了を待たない）
+        
+        Args:
+            user_id: 書き込み対象のユーザーID（同じユーザーの書き込みは投入順に実行される）
+            write: 書き込みを行うメソッド（save_messageなど）
+            args: writeに渡す引数
+        """
+        if user_id not in self._pending_writes:
+            self._pending_writes[user_id] = 0
+            self._writes_done[user_id] = asyncio.Event()
+        self._pending_writes[user_id] += 1
+        self._write_queue(user_id).put_nowait((user_id, write, args))
+    
+    async def flush_writes(self, user_id: str):
+        """このユーザーの投入済みの書き込みが済むまで待つ（同じワーカーの他のユーザーの書き込みは待たない）"""
+        done = self._writes_done.get(user_id)
+        if done is not None:
+            await done.wait()
+    
+    def _write_queue(self, user_id: str) -> asyncio.Queue:
+        """ユーザーを担当するワーカーのキューを取得（ワーカーは初回に起動する）"""
+        if not self._write_workers:
+            self._write_queues = [asyncio.Queue() for _ in range(self.WRITE_WORKERS)]
+            self._write_workers = [
+                asyncio.create_task(self._write_worker(queue))
+                for queue in self._write_queues
+            ]
+        return self._write_queues[hash(user_id) % self.WRITE_WORKERS]
+    
+    async def _write_worker(self, queue: asyncio.Queue):
+        """キューに入った書き込みを順に実行"""
+        while True:
+            user_id, write, args = await queue.get()
+            try:
+                await write(*args)
+            except Exception as e:
+                logger.error(f"Background write failed ({write.__name__}): {e}")
+            finally:
+                self._pending_writes[user_id] -= 1
+                if not self._pending_writes[user_id]:
+                    del self._pending_writes[user_id]
+                    self._writes_done.pop(user_id).set()
+                queue.task_done()
     
     async def initialize(self):
         """データベースの初期化"""
-        async with aiosqlite.connect(self.db_path) as db:
+        db = await self._conn()
+        async with self._write_lock:
             # 顧客テーブル
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS customers (
@@ -61,128 +211,266 @@ class Database:
                 )
             """)
             
+            # 会話要約テーブル（last_message_idまでのメッセージを要約済み）
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_summaries (
+                    user_id TEXT PRIMARY KEY,
+                    summary TEXT,
+                    last_message_id INTEGER,
+                    updated_at TEXT,
+                    FOREIGN KEY (user_id) REFERENCES customers(user_id)
+                )
+            """)
+            
+            # 会話履歴・言及済み事例はユーザー単位で引くためインデックスを張る
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_messages_uid_ts
+                ON messages(user_id, timestamp)
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_mentioned_uid
+                ON mentioned_cases(user_id)
+            """)
+            
             await db.commit()
     
     async def get_customer(self, user_id: str) -> Optional[Customer]:
         """顧客情報を取得"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM customers WHERE user_id = ?",
-                (user_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return Customer(
-                        user_id=row["user_id"],
-                        display_name=row["display_name"],
-                        occupation=row["occupation"],
-                        interest_genre=json.loads(row["interest_genre"] or "[]"),
-                        challenges=json.loads(row["challenges"] or "[]"),
-                        goals=row["goals"],
-                        persona=PersonaType(row["persona"]) if row["persona"] else PersonaType.UNKNOWN,
-                        status=ConversationStatus(row["status"]) if row["status"] else ConversationStatus.INITIAL,
-                        source=row["source"],
-                        created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else datetime.now(),
-                        updated_at=datetime.fromisoformat(row["updated_at"]) if row["updated_at"] else datetime.now()
-                    )
+        db = await self._read_conn()
+        async with db.execute(
+            "SELECT * FROM customers WHERE user_id = ?",
+            (user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                now = datetime.now()
+                # 各列は変換済みのため検証を省く（use_enum_valuesに合わせて列挙値は文字列のまま渡す）
+                return Customer.model_construct(
+                    user_id=row["user_id"],
+                    display_name=row["display_name"],
+                    occupation=row["occupation"],
+                    interest_genre=set(_decode_json_list(row["interest_genre"] or "[]")),
+                    challenges=set(_decode_json_list(row["challenges"] or "[]")),
+                    goals=row["goals"],
+                    persona=PersonaType(row["persona"]).value if row["persona"] else PersonaType.UNKNOWN.value,
+                    status=ConversationStatus(row["status"]).value if row["status"] else ConversationStatus.INITIAL.value,
+                    source=row["source"],
+                    created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else now,
+                    updated_at=datetime.fromisoformat(row["updated_at"]) if row["updated_at"] else now
+                )
         return None
     
-    async def save_customer(self, customer: Customer):
-        """顧客情報を保存"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT OR REPLACE INTO customers 
-                (user_id, display_name, occupation, interest_genre, challenges, 
-                 goals, persona, status, source, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                customer.user_id,
-                customer.display_name,
-                customer.occupation,
-                json.dumps(customer.interest_genre, ensure_ascii=False),
-                json.dumps(customer.challenges, ensure_ascii=False),
-                customer.goals,
-                customer.persona if isinstance(customer.persona, str) else customer.persona.value,
-                customer.status if isinstance(customer.status, str) else customer.status.value,
-                customer.source,
-                customer.created_at.isoformat(),
-                datetime.now().isoformat()
-            ))
+    async def save_customer(self, customer: Customer, now: Optional[datetime] = None):
+        """
+        顧客情報を保存
+        
+        Args:
+            customer: 顧客情報
+            now: 更新日時（同じイベント内の書き込みで時刻を共有する場合に指定）
+        """
+        db = await self._conn()
+        async with self._write_lock:
+            await self._execute_save_customer(db, customer, now)
             await db.commit()
     
+    async def save_turn(
+        self,
+        customer: Customer,
+        messages: List[Message],
+        now: Optional[datetime] = None
+    ):
+        """
+        1回のやり取りで更新された顧客情報とメッセージを1つのトランザクションで保存
+        
+        Args:
+            customer: 顧客情報
+            messages: 保存するメッセージ（この順にIDが振られる）
+            now: 更新日時（save_customerと同じ）
+        """
+        db = await self._conn()
+        async with self._write_lock:
+            await self._execute_save_customer(db, customer, now)
+            for message in messages:
+                await self._execute_save_message(db, message)
+            await db.commit()
+    
+    @staticmethod
+    async def _execute_save_customer(
+        db: aiosqlite.Connection,
+        customer: Customer,
+        now: Optional[datetime]
+    ):
+        """顧客情報のINSERT（コミットは呼び出し側で行う）"""
+        await db.execute("""
+            INSERT OR REPLACE INTO customers 
+            (user_id, display_name, occupation, interest_genre, challenges, 
+             goals, persona, status, source, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            customer.user_id,
+            customer.display_name,
+            customer.occupation,
+            _encode_json_list(tuple(sorted(customer.interest_genre))),
+            _encode_json_list(tuple(sorted(customer.challenges))),
+            customer.goals,
+            customer.persona_str,
+            customer.status if isinstance(customer.status, str) else customer.status.value,
+            customer.source,
+            customer.created_at.isoformat(),
+            (now or datetime.now()).isoformat()
+        ))
+    
     async def get_conversation_history(
         self, 
         user_id: str, 
-        limit: int = 20
+        limit: Optional[int] = 20,
+        after_id: int = 0
     ) -> List[Message]:
-        """会話履歴を取得"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                """SELECT * FROM messages 
-                   WHERE user_id = ? 
-                   ORDER BY timestamp DESC 
-                   LIMIT ?""",
-                (user_id, limit)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                messages = [
-                    Message(
-                        id=str(row["id"]),
-                        user_id=row["user_id"],
-                        role=row["role"],
-                        content=row["content"],
-                        timestamp=datetime.fromisoformat(row["timestamp"])
-                    )
-                    for row in rows
-                ]
-                return list(reversed(messages))  # 古い順に並べ替え
+        """
+        会話履歴を取得
+        
+        Args:
+            user_id: LINE ユーザーID
+            limit: 取得する件数（直近から数える。Noneなら全件）
+            after_id: このメッセージIDより後のものだけを返す
+        """
+        db = await self._read_conn()
+        # 直近limit件を取り出し、古い順に並べ替えて返す（SQLiteのLIMIT -1は上限なし）
+        async with db.execute(
+            """SELECT * FROM (
+                   SELECT * FROM messages 
+                   WHERE user_id = ? AND id > ?
+                   ORDER BY timestamp DESC, id DESC 
+                   LIMIT ?
+               )
+               ORDER BY timestamp ASC, id ASC""",
+            (user_id, after_id, -1 if limit is None else limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [
+                Message.model_construct(
+                    id=str(row["id"]),
+                    user_id=row["user_id"],
+                    role=row["role"],
+                    content=row["content"],
+                    timestamp=datetime.fromisoformat(row["timestamp"])
+                )
+                for row in rows
+            ]
     
     async def save_message(self, message: Message):
         """メッセージを保存"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT INTO messages (user_id, role, content, timestamp)
-                   VALUES (?, ?, ?, ?)""",
-                (message.user_id, message.role, message.content, message.timestamp.isoformat())
-            )
+        db = await self._conn()
+        async with self._write_lock:
+            await self._execute_save_message(db, message)
             await db.commit()
     
+    @staticmethod
+    async def _execute_save_message(db: aiosqlite.Connection, message: Message):
+        """メッセージのINSERT（コミットは呼び出し側で行う）"""
+        await db.execute(
+            """INSERT INTO messages (user_id, role, content, timestamp)
+               VALUES (?, ?, ?, ?)""",
+            (message.user_id, message.role, message.content, message.timestamp.isoformat())
+        )
+    
     async def get_mentioned_cases(self, user_id: str) -> List[str]:
         """言及済みの成功事例IDを取得"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT case_id FROM mentioned_cases WHERE user_id = ?",
-                (user_id,)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [row[0] for row in rows]
-    
-    async def add_mentioned_case(self, user_id: str, case_id: str):
-        """言及した成功事例を記録"""
-        async with aiosqlite.connect(self.db_path) as db:
+        db = await self._read_conn()
+        async with db.execute(
+            "SELECT case_id FROM mentioned_cases WHERE user_id = ?",
+            (user_id,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+    
+    async def add_mentioned_case(
+        self,
+        user_id: str,
+        case_id: str,
+        now: Optional[datetime] = None
+    ):
+        """言及した成功事例を記録（nowの扱いはsave_customerと同じ）"""
+        db = await self._conn()
+        async with self._write_lock:
             await db.execute(
                 """INSERT INTO mentioned_cases (user_id, case_id, mentioned_at)
                    VALUES (?, ?, ?)""",
-                (user_id, case_id, datetime.now().isoformat())
+                (user_id, case_id, (now or datetime.now()).isoformat())
+            )
+            await db.commit()
+    
+    async def get_summary(self, user_id: str) -> Tuple[Optional[str], int]:
+        """会話要約と、要約済みの最後のメッセージIDを取得"""
+        db = await self._read_conn()
+        async with db.execute(
+            "SELECT summary, last_message_id FROM conversation_summaries WHERE user_id = ?",
+            (user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return row["summary"], row["last_message_id"]
+        return None, 0
+    
+    async def save_summary(
+        self,
+        user_id: str,
+        summary: str,
+        last_message_id: int,
+        now: Optional[datetime] = None
+    ):
+        """会話要約を保存（nowの扱いはsave_customerと同じ）"""
+        db = await self._conn()
+        async with self._write_lock:
+            await db.execute(
+                """INSERT OR REPLACE INTO conversation_summaries
+                   (user_id, summary, last_message_id, updated_at)
+                   VALUES (?, ?, ?, ?)""",
+                (user_id, summary, last_message_id, (now or datetime.now()).isoformat())
             )
             await db.commit()
     
-    async def get_conversation_context(self, user_id: str) -> ConversationContext:
-        """会話コンテキストを取得"""
-        customer = await self.get_customer(user_id)
+    async def get_conversation_context(
+        self,
+        user_id: str,
+        history_limit: int = 10
+    ) -> ConversationContext:
+        """
+        会話コンテキストを取得
+        
+        Args:
+            user_id: LINE ユーザーID
+            history_limit: 取得する会話履歴の件数（AIエンジンが使う直近分のみ）
+        """
+        # キューに残っている書き込みを反映してから読む
+        await self.flush_writes(user_id)
+        
+        async def get_summary_and_history() -> Tuple[Optional[str], List[Message]]:
+            # 要約済みのメッセージは要約で代替する（件数の上限は要約されていないメッセージに適用する）
+            summary, summarized_until = await self.get_summary(user_id)
+            messages = await self.get_conversation_history(
+                user_id,
+                limit=history_limit,
+                after_id=summarized_until
+            )
+            return summary, messages
+        
+        # 互いに独立した読み込みをまとめて発行
+        customer, mentioned_cases, (summary, messages) = await asyncio.gather(
+            self.get_customer(user_id),
+            self.get_mentioned_cases(user_id),
+            get_summary_and_history()
+        )
+        
         if not customer:
             customer = Customer(user_id=user_id)
             await self.save_customer(customer)
         
-        messages = await self.get_conversation_history(user_id)
-        mentioned_cases = await self.get_mentioned_cases(user_id)
-        
         return ConversationContext(
             customer=customer,
             messages=messages,
-            mentioned_cases=mentioned_cases
+            mentioned_cases=mentioned_cases,
+            summary=summary
         )
 
 
@@ -0,0 +1,34 @@
+"""
+キーワードマッチング
+Aho-Corasick法で複数キーワードをメッセージ1回の走査で検出する
+"""
+from typing import Any, Dict, Iterator
+import ahocorasick
+
+
+class KeywordMatcher:
+    """複数キーワードの一括マッチャー"""
+    
+    def __init__(self, keywords: Dict[str, Any]):
+        """
+        Args:
+            keywords: キーワード → マッチ時に返す値 の辞書
+        """
+        self._automaton = ahocorasick.Automaton()
+        for keyword, value in keywords.items():
+            self._automaton.add_word(keyword, value)
+        self._empty = not keywords
+        if not self._empty:
+            self._automaton.make_automaton()
+    
+    def iter(self, text: str) -> Iterator[Any]:
+        """テキスト中に出現したキーワードの値を出現順に返す（重複を含む）"""
+        if self._empty or not text:
+            return iter(())
+        return (value for _, value in self._automaton.iter(text))
+    
+    def search(self, text: str) -> bool:
+        """いずれかのキーワードが含まれるかどうか"""
+        for _ in self.iter(text):
+            return True
+        return False
@@ -2,15 +2,103 @@
 ナレッジベース管理
 成功事例・FAQ・お役立ち情報を管理し、パーソナライズ検索を提供
 """
-import json
+import heapq
+import logging
+import math
+import operator
+import os
+import pickle
+from collections import defaultdict
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
+import orjson
 from app.models import SuccessCase, FAQ, PersonaType
 
+logger = logging.getLogger(__name__)
+
+
+def _replace_file(path: Path, payload: bytes):
+    """一時ファイルに書いてから置き換える（並行して読むプロセスに書きかけの内容を見せない）"""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(payload)
+    os.replace(tmp_path, path)
+
+
+class SubstringIndex:
+    """
+    部分一致検索用の転置インデックス
+    文字のunigram/bigramで候補を絞り込み、元の文字列で一致を確認する
+    """
+    
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = defaultdict(set)
+        self._texts: Dict[int, List[str]] = defaultdict(list)
+    
+    @staticmethod
+    def _grams(text: str) -> Set[str]:
+        """文字unigram・bigramを列挙"""
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        return grams
+    
+    def add(self, doc: int, text: str):
+        """文書番号にテキストを登録"""
+        self._texts[doc].append(text)
+        for gram in self._grams(text):
+            self._postings[gram].add(doc)
+    
+    def search(self, query: str) -> Set[int]:
+        """queryを部分文字列として含むテキストを持つ文書番号を返す"""
+        if not query:
+            return set(self._texts)
+        
+        if len(query) == 1:
+            return set(self._postings.get(query, ()))
+        
+        candidates: Optional[Set[int]] = None
+        for i in range(len(query) - 1):
+            posting = self._postings.get(query[i:i + 2])
+            if not posting:
+                return set()
+            candidates = set(posting) if candidates is None else candidates & posting
+            if not candidates:
+                return set()
+        
+        return {
+            doc for doc in candidates
+            if any(query in text for text in self._texts[doc])
+        }
+
 
 class KnowledgeBase:
     """ナレッジベース管理クラス"""
     
+    SOURCE_FILES = ("success_cases.json", "faq.json")
+    SNAPSHOT_FILE = ".cache.pkl"
+    # スナップショットの構造を変えた場合は上げる
+    SNAPSHOT_VERSION = 2
+    
+    # 埋め込みベクトルのキャッシュ（モデル名・テキストごと）
+    EMBEDDINGS_FILE = ".embeddings.pkl"
+    # 意味検索で候補とする上位件数と、採用する最低類似度
+    SEMANTIC_CANDIDATES = 20
+    SEMANTIC_MIN_SIMILARITY = 0.3
+    # Reciprocal Rank Fusion の定数
+    RRF_K = 60
+    
+    # スナップショットに含める属性
+    _SNAPSHOT_ATTRS = (
+        "success_cases",
+        "faqs",
+        "_case_persona_index",
+        "_case_keyword_index",
+        "_case_challenge_index",
+        "_case_genre_index",
+        "_faq_keyword_index",
+        "_faq_question_index",
+        "_faq_answer_index",
+    )
+    
     def __init__(self, data_dir: str = "data/knowledge"):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(parents=True, exist_ok=True)
@@ -18,25 +106,152 @@ class KnowledgeBase:
         self.success_cases: List[SuccessCase] = []
         self.faqs: List[FAQ] = []
         
+        # 検索用インデックス（値はリスト内の位置）
+        self._case_persona_index: Dict[str, Set[int]] = {}
+        self._case_keyword_index: Dict[str, Set[int]] = {}
+        self._case_challenge_index = SubstringIndex()
+        # ジャンルは大文字小文字を区別しないため小文字化して登録
+        self._case_genre_index = SubstringIndex()
+        self._faq_keyword_index: Dict[str, Set[int]] = {}
+        self._faq_question_index = SubstringIndex()
+        self._faq_answer_index = SubstringIndex()
+        
+        # 意味検索用の埋め込み（テキスト → 正規化済みベクトル）
+        self._embedding_model: Optional[str] = None
+        self._embedding_vectors: Dict[str, List[float]] = {}
+        self._case_embeddings: List[Optional[List[float]]] = []
+        self._faq_embeddings: List[Optional[List[float]]] = []
+        
+        # 読み込み済みのソースJSONの更新時刻（同じなら再読み込みしない）
+        self._loaded_sources: Optional[Dict[str, int]] = None
+        
+        # 一覧API用のJSON（読み込み後の初回に変換し、読み込み直すまで使い回す）
+        self._success_cases_json: Optional[bytes] = None
+        self._faqs_json: Optional[bytes] = None
+    
     def load(self):
         """ナレッジベースを読み込み"""
+        # 読み込み済みの内容からJSONが更新されていなければ何もしない
+        if self._loaded_sources is not None and self._loaded_sources == self._source_mtimes():
+            return
+        
+        self._success_cases_json = None
+        self._faqs_json = None
+        
+        # JSONが更新されていなければ、構築済みのスナップショットを使う
+        if self._load_snapshot():
+            self._align_embeddings()
+            self._loaded_sources = self._source_mtimes()
+            return
+        
         # 成功事例
         cases_file = self.data_dir / "success_cases.json"
         if cases_file.exists():
-            with open(cases_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self.success_cases = [SuccessCase(**case) for case in data]
+            data = orjson.loads(cases_file.read_bytes())
+            self.success_cases = [SuccessCase(**case) for case in data]
         else:
             self._create_default_success_cases()
         
         # FAQ
         faq_file = self.data_dir / "faq.json"
         if faq_file.exists():
-            with open(faq_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self.faqs = [FAQ(**faq) for faq in data]
+            data = orjson.loads(faq_file.read_bytes())
+            self.faqs = [FAQ(**faq) for faq in data]
         else:
             self._create_default_faqs()
+        
+        self._build_indexes()
+        self._save_snapshot()
+        self._align_embeddings()
+        self._loaded_sources = self._source_mtimes()
+    
+    def _source_mtimes(self) -> Optional[Dict[str, int]]:
+        """ソースJSONの更新時刻（いずれかが無ければNone）"""
+        mtimes = {}
+        for name in self.SOURCE_FILES:
+            path = self.data_dir / name
+            if not path.exists():
+                return None
+            mtimes[name] = path.stat().st_mtime_ns
+        return mtimes
+    
+    def _load_snapshot(self) -> bool:
+        """ソースと一致するスナップショットがあれば読み込む"""
+        snapshot_file = self.data_dir / self.SNAPSHOT_FILE
+        sources = self._source_mtimes()
+        if sources is None or not snapshot_file.exists():
+            return False
+        
+        try:
+            with open(snapshot_file, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to read knowledge snapshot: {e}")
+            return False
+        
+        if (
+            not isinstance(snapshot, dict)
+            or snapshot.get("version") != self.SNAPSHOT_VERSION
+            or snapshot.get("sources") != sources
+        ):
+            return False
+        
+        self.__dict__.update(snapshot["state"])
+        return True
+    
+    def _save_snapshot(self):
+        """読み込み結果とインデックスをスナップショットとして保存"""
+        sources = self._source_mtimes()
+        if sources is None:
+            return
+        
+        snapshot = {
+            "version": self.SNAPSHOT_VERSION,
+            "sources": sources,
+            "state": {attr: getattr(self, attr) for attr in self._SNAPSHOT_ATTRS},
+        }
+        try:
+            _replace_file(
+                self.data_dir / self.SNAPSHOT_FILE,
+                pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            )
+        except OSError as e:
+            logger.warning(f"Failed to write knowledge snapshot: {e}")
+    
+    def _build_indexes(self):
+        """検索用の転置インデックスを構築"""
+        persona_index: Dict[str, Set[int]] = defaultdict(set)
+        keyword_index: Dict[str, Set[int]] = defaultdict(set)
+        challenge_index = SubstringIndex()
+        genre_index = SubstringIndex()
+        
+        for pos, case in enumerate(self.success_cases):
+            for persona in case.related_personas:
+                persona_index[persona].add(pos)
+            for keyword in case.keywords:
+                keyword_index[keyword].add(pos)
+            for challenge in case.related_challenges:
+                challenge_index.add(pos, challenge)
+            genre_index.add(pos, case.genre.lower())
+        
+        self._case_persona_index = dict(persona_index)
+        self._case_keyword_index = dict(keyword_index)
+        self._case_challenge_index = challenge_index
+        self._case_genre_index = genre_index
+        
+        faq_keyword_index: Dict[str, Set[int]] = defaultdict(set)
+        question_index = SubstringIndex()
+        answer_index = SubstringIndex()
+        
+        for pos, faq in enumerate(self.faqs):
+            for keyword in faq.keywords:
+                faq_keyword_index[keyword].add(pos)
+            question_index.add(pos, faq.question)
+            answer_index.add(pos, faq.answer)
+        
+        self._faq_keyword_index = dict(faq_keyword_index)
+        self._faq_question_index = question_index
+        self._faq_answer_index = answer_index
     
     def _create_default_success_cases(self):
         """デフォルトの成功事例を作成"""
@@ -199,17 +414,150 @@ class KnowledgeBase:
         self.faqs = [FAQ(**faq) for faq in default_faqs]
         self._save_faqs()
     
+    @staticmethod
+    def _write_json(path: Path, records: List[Dict[str, Any]]):
+        """JSON（UTF-8・インデント付き）を保存。内容が同じなら書き込まない"""
+        payload = orjson.dumps(
+            records,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+        )
+        # 更新時刻を変えなければスナップショットも有効なまま
+        if path.exists() and path.read_bytes() == payload:
+            return
+        _replace_file(path, payload)
+    
     def _save_success_cases(self):
         """成功事例を保存"""
-        cases_file = self.data_dir / "success_cases.json"
-        with open(cases_file, "w", encoding="utf-8") as f:
-            json.dump([case.model_dump() for case in self.success_cases], f, ensure_ascii=False, indent=2)
+        self._write_json(
+            self.data_dir / "success_cases.json",
+            [case.model_dump(mode="json") for case in self.success_cases]
+        )
     
     def _save_faqs(self):
         """FAQを保存"""
-        faq_file = self.data_dir / "faq.json"
-        with open(faq_file, "w", encoding="utf-8") as f:
-            json.dump([faq.model_dump() for faq in self.faqs], f, ensure_ascii=False, indent=2)
+        self._write_json(
+            self.data_dir / "faq.json",
+            [faq.model_dump(mode="json") for faq in self.faqs]
+        )
+    
+    @staticmethod
+    def _case_embedding_text(case: SuccessCase) -> str:
+        """成功事例の埋め込み対象テキスト"""
+        return f"{case.title}\n{case.success_points}"
+    
+    @staticmethod
+    def _faq_embedding_text(faq: FAQ) -> str:
+        """FAQの埋め込み対象テキスト"""
+        return faq.question
+    
+    def success_cases_json(self) -> bytes:
+        """成功事例一覧のJSON"""
+        if self._success_cases_json is None:
+            self._success_cases_json = orjson.dumps(
+                [case.model_dump(mode="json") for case in self.success_cases]
+            )
+        return self._success_cases_json
+    
+    def faqs_json(self) -> bytes:
+        """FAQ一覧のJSON"""
+        if self._faqs_json is None:
+            self._faqs_json = orjson.dumps([faq.model_dump(mode="json") for faq in self.faqs])
+        return self._faqs_json
+    
+    def embedding_texts(self) -> List[str]:
+        """埋め込みが必要なテキスト一覧（重複なし）"""
+        texts = [self._case_embedding_text(case) for case in self.success_cases]
+        texts += [self._faq_embedding_text(faq) for faq in self.faqs]
+        return list(dict.fromkeys(texts))
+    
+    @property
+    def has_embeddings(self) -> bool:
+        """意味検索が利用可能かどうか"""
+        return bool(self._embedding_vectors)
+    
+    def load_embedding_cache(self, model: str) -> Dict[str, List[float]]:
+        """保存済みの埋め込みを読み込む（モデルが異なれば空）"""
+        cache_file = self.data_dir / self.EMBEDDINGS_FILE
+        if not cache_file.exists():
+            return {}
+        
+        try:
+            with open(cache_file, "rb") as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to read embedding cache: {e}")
+            return {}
+        
+        if not isinstance(cache, dict) or cache.get("model") != model:
+            return {}
+        return cache.get("vectors", {})
+    
+    def set_embeddings(self, model: str, vectors: Dict[str, List[float]]):
+        """
+        埋め込みを登録し、キャッシュとして保存
+        
+        Args:
+            model: 埋め込みモデル名
+            vectors: テキスト → 埋め込みベクトル
+        """
+        try:
+            _replace_file(
+                self.data_dir / self.EMBEDDINGS_FILE,
+                pickle.dumps({"model": model, "vectors": vectors}, protocol=pickle.HIGHEST_PROTOCOL)
+            )
+        except OSError as e:
+            logger.warning(f"Failed to write embedding cache: {e}")
+        
+        self._embedding_model = model
+        self._embedding_vectors = {
+            text: self._normalize(vector) for text, vector in vectors.items()
+        }
+        self._align_embeddings()
+    
+    def _align_embeddings(self):
+        """成功事例・FAQの並びに合わせて埋め込みを割り当てる"""
+        self._case_embeddings = [
+            self._embedding_vectors.get(self._case_embedding_text(case))
+            for case in self.success_cases
+        ]
+        self._faq_embeddings = [
+            self._embedding_vectors.get(self._faq_embedding_text(faq))
+            for faq in self.faqs
+        ]
+    
+    @staticmethod
+    def _normalize(vector: List[float]) -> List[float]:
+        """ベクトルを単位長に正規化"""
+        norm = math.sqrt(sum(v * v for v in vector))
+        return [v / norm for v in vector] if norm else list(vector)
+    
+    def _semantic_rank(
+        self,
+        embeddings: List[Optional[List[float]]],
+        query_embedding: List[float],
+        allowed: Set[int]
+    ) -> List[int]:
+        """コサイン類似度の高い順に位置を返す"""
+        query = self._normalize(query_embedding)
+        similarities = []
+        for pos in allowed:
+            vector = embeddings[pos] if pos < len(embeddings) else None
+            if vector is None:
+                continue
+            similarity = sum(map(operator.mul, vector, query))
+            if similarity >= self.SEMANTIC_MIN_SIMILARITY:
+                similarities.append((similarity, -pos))
+        
+        top = heapq.nlargest(self.SEMANTIC_CANDIDATES, similarities)
+        return [-neg_pos for _, neg_pos in top]
+    
+    def _fuse_rankings(self, *rankings: List[int]) -> List[int]:
+        """Reciprocal Rank Fusion で複数の順位を統合"""
+        fused: Dict[int, float] = defaultdict(float)
+        for ranking in rankings:
+            for rank, pos in enumerate(ranking):
+                fused[pos] += 1.0 / (self.RRF_K + rank + 1)
+        return sorted(fused, key=lambda pos: (-fused[pos], pos))
     
     def search_success_cases(
         self,
@@ -218,80 +566,99 @@ class KnowledgeBase:
         genre: Optional[str] = None,
         keywords: Optional[List[str]] = None,
         exclude_ids: Optional[List[str]] = None,
-        limit: int = 3
+        limit: int = 3,
+        query_embedding: Optional[List[float]] = None
     ) -> List[SuccessCase]:
-        """成功事例を検索"""
-        results = []
-        exclude_ids = exclude_ids or []
+        """
+        成功事例を検索
         
-        for case in self.success_cases:
-            if case.id in exclude_ids:
-                continue
-            
-            score = 0
-            
-            # ペルソナマッチング
-            if persona and persona in case.related_personas:
-                score += 3
-            
-            # 課題マッチング
-            if challenges:
-                for challenge in challenges:
-                    if any(challenge in c for c in case.related_challenges):
-                        score += 2
-            
-            # ジャンルマッチング
-            if genre and genre.lower() in case.genre.lower():
-                score += 2
-            
-            # キーワードマッチング
-            if keywords:
-                for keyword in keywords:
-                    if keyword in case.keywords:
-                        score += 1
-            
-            if score > 0:
-                results.append((score, case))
-        
-        # スコア順にソートして上位を返す
-        results.sort(key=lambda x: x[0], reverse=True)
-        return [case for _, case in results[:limit]]
+        query_embeddingを渡し、埋め込みが登録済みの場合は
+        キーワードスコアの順位と意味的な類似度の順位を統合する
+        """
+        exclude_ids = set(exclude_ids or [])
+        scores: Dict[int, int] = defaultdict(int)
+        
+        # ペルソナマッチング
+        if persona:
+            for pos in self._case_persona_index.get(persona, ()):
+                scores[pos] += 3
+        
+        # 課題マッチング
+        if challenges:
+            for challenge in challenges:
+                for pos in self._case_challenge_index.search(challenge):
+                    scores[pos] += 2
+        
+        # ジャンルマッチング
+        if genre:
+            for pos in self._case_genre_index.search(genre.lower()):
+                scores[pos] += 2
+        
+        # キーワードマッチング
+        if keywords:
+            for keyword in keywords:
+                for pos in self._case_keyword_index.get(keyword, ()):
+                    scores[pos] += 1
+        
+        candidates = (
+            pos for pos, score in scores.items()
+            if score > 0 and self.success_cases[pos].id not in exclude_ids
+        )
+        
+        if query_embedding is not None and self.has_embeddings:
+            keyword_ranked = sorted(candidates, key=lambda pos: (-scores[pos], pos))
+            allowed = {
+                pos for pos, case in enumerate(self.success_cases)
+                if case.id not in exclude_ids
+            }
+            semantic_ranked = self._semantic_rank(self._case_embeddings, query_embedding, allowed)
+            top = self._fuse_rankings(keyword_ranked, semantic_ranked)[:limit]
+        else:
+            # スコア上位limit件のみを選択（同点は登録順）
+            top = heapq.nlargest(limit, candidates, key=lambda pos: (scores[pos], -pos))
+        return [self.success_cases[pos] for pos in top]
     
     def search_faqs(
         self,
         keywords: Optional[List[str]] = None,
         category: Optional[str] = None,
-        limit: int = 3
+        limit: int = 3,
+        query_embedding: Optional[List[float]] = None
     ) -> List[FAQ]:
-        """FAQを検索"""
-        results = []
-        
-        for faq in self.faqs:
-            score = 0
-            
-            # カテゴリマッチング
-            if category and category in faq.category:
-                score += 2
-            
-            # キーワードマッチング
-            if keywords:
-                for keyword in keywords:
-                    # 質問文でマッチング
-                    if keyword in faq.question:
-                        score += 3
-                    # キーワードリストでマッチング
-                    if keyword in faq.keywords:
-                        score += 2
-                    # 回答文でマッチング
-                    if keyword in faq.answer:
-                        score += 1
-            
-            if score > 0:
-                results.append((score, faq))
-        
-        # スコア順にソートして上位を返す
-        results.sort(key=lambda x: x[0], reverse=True)
-        return [faq for _, faq in results[:limit]]
+        """FAQを検索（query_embeddingの扱いはsearch_success_casesと同じ）"""
+        scores: Dict[int, int] = defaultdict(int)
+        
+        # カテゴリマッチング
+        if category:
+            for pos, faq in enumerate(self.faqs):
+                if category in faq.category:
+                    scores[pos] += 2
+        
+        # キーワードマッチング
+        if keywords:
+            for keyword in keywords:
+                # 質問文でマッチング
+                for pos in self._faq_question_index.search(keyword):
+                    scores[pos] += 3
+                # キーワードリストでマッチング
+                for pos in self._faq_keyword_index.get(keyword, ()):
+                    scores[pos] += 2
+                # 回答文でマッチング
+                for pos in self._faq_answer_index.search(keyword):
+                    scores[pos] += 1
+        
+        candidates = (pos for pos, score in scores.items() if score > 0)
+        
+        if query_embedding is not None and self.has_embeddings:
+            keyword_ranked = sorted(candidates, key=lambda pos: (-scores[pos], pos))
+            semantic_ranked = self._semantic_rank(
+                self._faq_embeddings, query_embedding, set(range(len(self.faqs)))
+            )
+            top = self._fuse_rankings(keyword_ranked, semantic_ranked)[:limit]
+        else:
+            # スコア上位limit件のみを選択（同点は登録順）
+            top = heapq.nlargest(limit, candidates, key=lambda pos: (scores[pos], -pos))
+        return [self.faqs[pos] for pos in top]
     
     def get_case_by_id(self, case_id: str) -> Optional[SuccessCase]:
         """IDで成功事例を取得"""
@@ -3,13 +3,16 @@ LINE Webhook ハンドラー
 LINE Messaging APIからのイベントを処理
 Lステップとの連携機能を含む
 """
+import asyncio
 import hashlib
 import hmac
 import base64
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 import logging
-from linebot.v3 import WebhookHandler
+import time
+from collections import OrderedDict, defaultdict
+import orjson
 from linebot.v3.messaging import (
     AsyncApiClient,
     AsyncMessagingApi,
@@ -19,6 +22,7 @@ from linebot.v3.messaging import (
     PushMessageRequest
 )
 from linebot.v3.webhooks import (
+    Event,
     MessageEvent,
     TextMessageContent,
     FollowEvent,
@@ -28,91 +32,150 @@ from linebot.v3.exceptions import InvalidSignatureError
 
 from app.models import Customer, Message, ConversationStatus, PersonaType
 from app.database import db
-from app.ai_engine import ai_engine
-from app.lstep_client import lstep_client, LstepDataMapper
+import app.ai_engine as ai_engine_module
+import app.lstep_client as lstep_client_module
+from app.ai_engine import AIEngine
+from app.lstep_client import LstepClient, LstepDataMapper
+from app.keyword_matcher import KeywordMatcher
 
 logger = logging.getLogger(__name__)
 
+# 人間への転送を希望していると判断するキーワード
+HANDOFF_KEYWORDS = (
+    "人と話したい",
+    "担当者と話したい",
+    "スタッフと話したい",
+    "人間と話したい",
+    "オペレーター",
+    "問い合わせ",
+    "クレーム",
+    "返金",
+    "解約"
+)
+_HANDOFF_MATCHER = KeywordMatcher({keyword: True for keyword in HANDOFF_KEYWORDS})
+
+# 友だち情報が渡されていない（取得が必要な）ことを表す値（取得結果のNoneと区別する）
+_NOT_FETCHED: Any = object()
+
 
 class LineHandler:
     """LINE Webhookハンドラークラス"""
     
+    # AI対話モードの判定結果のキャッシュ（秒・件数）
+    AI_MODE_CACHE_TTL = 60.0
+    AI_MODE_CACHE_SIZE = 4096
+    
     def __init__(
         self, 
         channel_access_token: str, 
         channel_secret: str,
-        ai_mode_tag: str = "AI対話モード"
+        ai_mode_tag: str = "AI対話モード",
+        ai_engine: Optional[AIEngine] = None,
+        lstep_client: Optional[LstepClient] = None
     ):
         self.channel_secret = channel_secret
+        # 鍵を設定済みのHMACをリクエストごとにコピーして使う
+        self._hmac_template = hmac.new(channel_secret.encode('utf-8'), digestmod=hashlib.sha256)
         self.ai_mode_tag = ai_mode_tag
         
+        # AIエンジン・Lステップ連携（未指定時は初期化済みのグローバルインスタンスをこの時点で参照する）
+        self.ai_engine = ai_engine if ai_engine is not None else ai_engine_module.ai_engine
+        self.lstep_client = lstep_client if lstep_client is not None else lstep_client_module.lstep_client
+        
         # LINE API設定
         configuration = Configuration(access_token=channel_access_token)
         self.api_client = AsyncApiClient(configuration)
         self.line_bot_api = AsyncMessagingApi(self.api_client)
         
-        # Webhookハンドラー
-        self.handler = WebhookHandler(channel_secret)
+        # Webhookのイベント処理・会話要約などのバックグラウンドタスク（GCされないよう参照を保持）
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._summarizing: Set[str] = set()
         
-        # イベントハンドラーを登録
-        self._register_handlers()
-    
-    def _register_handlers(self):
-        """イベントハンドラーを登録"""
-        
-        @self.handler.add(FollowEvent)
-        async def handle_follow(event: FollowEvent):
-            """友だち追加イベント"""
-            await self._handle_follow(event)
+        # ユーザーごとのイベント処理のロックと、それを使っている（待っている）Webhookの数
+        self._user_locks: Dict[str, asyncio.Lock] = {}
+        self._user_lock_users: Dict[str, int] = defaultdict(int)
         
-        @self.handler.add(UnfollowEvent)
-        async def handle_unfollow(event: UnfollowEvent):
-            """ブロックイベント"""
-            await self._handle_unfollow(event)
+        # ユーザーごとのAI対話モード（user_id → (判定時刻, 有効か)）
+        self._ai_mode_cache: "OrderedDict[str, Tuple[float, bool]]" = OrderedDict()
+    
+    async def _dispatch(self, event: Event):
+        """イベントを種類ごとの処理に振り分ける"""
+        try:
+            if isinstance(event, FollowEvent):
+                # 友だち追加イベント
+                await self._handle_follow(event)
+            elif isinstance(event, UnfollowEvent):
+                # ブロックイベント
+                await self._handle_unfollow(event)
+            elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+                # テキストメッセージイベント
+                await self._handle_text_message(event)
+        except Exception as e:
+            logger.error(f"Failed to handle {type(event).__name__}: {e}")
+    
+    async def _dispatch_in_order(self, user_id: Optional[str], events: List[Event]):
+        """同じユーザーのイベントを届いた順に処理（別のWebhookで届いたイベントの処理とも重ねない）"""
+        if user_id is None:
+            for event in events:
+                await self._dispatch(event)
+            return
         
-        @self.handler.add(MessageEvent, message=TextMessageContent)
-        async def handle_text_message(event: MessageEvent):
-            """テキストメッセージイベント"""
-            await self._handle_text_message(event)
+        # ロックは待っているWebhookがなくなったら捨てる（asyncio.Lockは待った順に取れる）
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        self._user_lock_users[user_id] += 1
+        try:
+            async with lock:
+                for event in events:
+                    await self._dispatch(event)
+        finally:
+            self._user_lock_users[user_id] -= 1
+            if not self._user_lock_users[user_id]:
+                del self._user_lock_users[user_id]
+                del self._user_locks[user_id]
     
     async def _handle_follow(self, event: FollowEvent):
         """友だち追加時の処理"""
         user_id = event.source.user_id
+        # このイベント内の書き込み（メッセージの時刻を含む）は同じ時刻を使う
+        now = datetime.now()
         
-        # ユーザープロファイルを取得
-        try:
-            profile = await self.line_bot_api.get_profile(user_id)
-            display_name = profile.display_name
-        except Exception:
-            display_name = None
+        # LINEの表示名とLステップの友だち情報を同時に取得
+        display_name, friend = await asyncio.gather(
+            self._get_display_name(user_id),
+            self._get_lstep_friend(user_id)
+        )
         
-        # 顧客情報を作成
-        customer = Customer(
+        # 顧客情報を作成（値は自前で用意したものなので検証を省く）
+        customer = Customer.model_construct(
             user_id=user_id,
             display_name=display_name,
-            status=ConversationStatus.INITIAL,
-            created_at=datetime.now(),
-            updated_at=datetime.now()
+            status=ConversationStatus.INITIAL.value,
+            created_at=now,
+            updated_at=now
         )
         
-        # Lステップから追加情報を取得
-        customer = await self._enrich_customer_from_lstep(customer)
+        # Lステップから追加情報を反映（取得済みの友だち情報を使う）
+        customer = await self._enrich_customer_from_lstep(customer, friend=friend)
         
-        # 保存
-        await db.save_customer(customer)
+        # 保存はバックグラウンドで行い、AI対話モードを確認（これも取得済みの友だち情報で判定する）
+        db.submit_write(user_id, db.save_customer, customer, now)
+        ai_enabled = await self._should_ai_respond(user_id, friend=friend)
         
         # AI対話モードがONの場合のみウェルカムメッセージを送信
-        if await self._should_ai_respond(user_id):
-            if ai_engine:
-                welcome_message = await ai_engine.generate_welcome_message(customer)
+        if ai_enabled:
+            if self.ai_engine:
+                welcome_message = await self.ai_engine.generate_welcome_message(customer)
                 
                 # メッセージを保存
-                assistant_msg = Message(
+                assistant_msg = Message.model_construct(
                     user_id=user_id,
                     role="assistant",
-                    content=welcome_message
+                    content=welcome_message,
+                    timestamp=now
                 )
-                await db.save_message(assistant_msg)
+                db.submit_write(user_id, db.save_message, assistant_msg)
                 
                 # 返信
                 await self.line_bot_api.reply_message(
@@ -124,68 +187,114 @@ class LineHandler:
         else:
             logger.info(f"AI mode not enabled for user {user_id}, skipping welcome message")
     
+    async def _get_display_name(self, user_id: str) -> Optional[str]:
+        """LINEの表示名を取得（失敗時はNone）"""
+        try:
+            profile = await self.line_bot_api.get_profile(user_id)
+            return profile.display_name
+        except Exception:
+            return None
+    
+    async def _get_lstep_friend(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Lステップの友だち情報を取得（未設定・失敗時はNone）"""
+        if not self.lstep_client:
+            return None
+        try:
+            return await self.lstep_client.get_friend(user_id)
+        except Exception as e:
+            logger.error(f"Failed to get friend from Lstep: {e}")
+            return None
+    
     async def _handle_unfollow(self, event: UnfollowEvent):
         """ブロック時の処理"""
         # 必要に応じてログを記録
         user_id = event.source.user_id
-        print(f"User {user_id} unfollowed")
+        logger.info("User %s unfollowed", user_id)
     
     async def _handle_text_message(self, event: MessageEvent):
         """テキストメッセージの処理"""
         user_id = event.source.user_id
         user_message = event.message.text
+        # このイベント内の書き込み（メッセージの時刻を含む）は同じ時刻を使う
+        now = datetime.now()
         
         # AI対話モードを確認
         if not await self._should_ai_respond(user_id):
             logger.info(f"AI mode not enabled for user {user_id}, ignoring message")
             return  # Lステップに処理を任せる
         
-        # ユーザーメッセージを保存
-        user_msg = Message(
+        # 保存用のメッセージは型が確定しているため検証を省いて作る
+        user_msg = Message.model_construct(
             user_id=user_id,
             role="user",
-            content=user_message
+            content=user_message,
+            timestamp=now
         )
-        await db.save_message(user_msg)
         
         # 人間への転送リクエストを検知
         if self._is_handoff_request(user_message):
+            db.submit_write(user_id, db.save_message, user_msg)
             await self._handle_handoff(event, user_id, user_message)
             return
         
-        # 会話コンテキストを取得
+        # 会話コンテキストを取得（今回のメッセージは履歴ではなく最後のuserメッセージとして渡し、
+        # 保存は応答と同じトランザクションで行う）
         context = await db.get_conversation_context(user_id)
         
         # Lステップから最新情報を取得して反映
+        # （友だち情報はキャッシュ済みならAPIを呼ばない）
         context.customer = await self._enrich_customer_from_lstep(context.customer)
         
         # AI応答を生成
-        if ai_engine:
-            response_text = await ai_engine.generate_response(context, user_message)
+        if self.ai_engine:
+            # 応答をストリーミングで受け取り、最初のまとまりはすぐに返信する
+            # （残りは生成完了後に1通のプッシュメッセージで送る）
+            segments = []
+            try:
+                async for segment in self.ai_engine.generate_response_stream(context, user_message):
+                    if not segments:
+                        await self.line_bot_api.reply_message(
+                            ReplyMessageRequest(
+                                reply_token=event.reply_token,
+                                messages=[TextMessage(text=segment.strip())]
+                            )
+                        )
+                    segments.append(segment)
+                
+                rest = "".join(segments[1:]).strip()
+                if rest:
+                    await self.line_bot_api.push_message(
+                        PushMessageRequest(
+                            to=user_id,
+                            messages=[TextMessage(text=rest)]
+                        )
+                    )
+            except Exception:
+                # 応答できなかった場合もユーザーメッセージは残す
+                db.submit_write(user_id, db.save_message, user_msg)
+                raise
+            response_text = "".join(segments)
             
-            # 顧客情報を更新（ペルソナ分析の結果）
-            await db.save_customer(context.customer)
+            # 顧客情報（ペルソナ分析の結果）とユーザー・応答メッセージを1つのトランザクションで保存
+            # （応答が空の場合は何も送っていないため、空のメッセージを履歴・要約に残さない）
+            turn_messages = [user_msg]
+            if response_text.strip():
+                turn_messages.append(Message.model_construct(
+                    user_id=user_id,
+                    role="assistant",
+                    content=response_text,
+                    timestamp=now
+                ))
+            db.submit_write(user_id, db.save_turn, context.customer, turn_messages, now)
             
             # Lステップにもペルソナ情報を同期
             await self._sync_to_lstep(context.customer)
             
-            # 応答メッセージを保存
-            assistant_msg = Message(
-                user_id=user_id,
-                role="assistant",
-                content=response_text
-            )
-            await db.save_message(assistant_msg)
-            
-            # 返信
-            await self.line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response_text)]
-                )
-            )
+            # 会話の要約は返信の後にバックグラウンドで更新する
+            self._schedule_summary_refresh(user_id)
         else:
             # AIエンジンが初期化されていない場合
+            db.submit_write(user_id, db.save_message, user_msg)
             await self.line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -195,51 +304,130 @@ class LineHandler:
                 )
             )
     
-    async def _should_ai_respond(self, user_id: str) -> bool:
+    def _schedule_summary_refresh(self, user_id: str):
+        """会話要約の更新をバックグラウンドで開始（同じユーザーの更新中は何もしない）"""
+        if user_id in self._summarizing:
+            return
+        self._summarizing.add(user_id)
+        self._run_in_background(self._refresh_summary(user_id))
+    
+    def _run_in_background(self, coro):
+        """コルーチンをバックグラウンドタスクとして開始"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def wait_background_tasks(self):
+        """実行中のバックグラウンドタスクの完了を待つ（シャットダウン時用）"""
+        while self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+    
+    async def _refresh_summary(self, user_id: str):
+        """要約されていないメッセージがたまっていれば要約に畳み込む"""
+        try:
+            # 直前のメッセージの保存を待ってから読む
+            await db.flush_writes(user_id)
+            # 要約されていないメッセージは件数で切らずにすべて畳み込む
+            # （一部だけ読むと、読まなかったメッセージまで要約済みとして扱ってしまう）
+            summary, summarized_until = await db.get_summary(user_id)
+            messages = await db.get_conversation_history(
+                user_id,
+                limit=None,
+                after_id=summarized_until
+            )
+            if not self.ai_engine.needs_summary(messages):
+                return
+            
+            # 直近のメッセージは原文のまま残す
+            folded = messages[:-self.ai_engine.SUMMARY_KEEP_MESSAGES]
+            new_summary = await self.ai_engine.summarize_conversation(summary, folded)
+            await db.save_summary(user_id, new_summary, int(folded[-1].id))
+        except Exception as e:
+            logger.error(f"Failed to refresh conversation summary: {e}")
+        finally:
+            self._summarizing.discard(user_id)
+    
+    async def _should_ai_respond(self, user_id: str, friend: Optional[Dict[str, Any]] = _NOT_FETCHED) -> bool:
         """
         AI対話モードが有効かどうかを確認
         Lステップで特定のタグが付いている場合のみAIが応答
+        
+        Args:
+            user_id: LINE ユーザーID
+            friend: 取得済みの友だち情報（Noneを含め、指定時はキャッシュも見ずにこれで判定する）
         """
-        if not lstep_client:
+        if not self.lstep_client:
             # Lステップ未設定の場合は常にAIが応答
             return True
         
-        try:
-            tags = await lstep_client.get_friend_tags(user_id)
-            return self.ai_mode_tag in tags
-        except Exception as e:
-            logger.error(f"Failed to check AI mode tag: {e}")
-            # エラー時はAIが応答する（フォールバック）
-            return True
+        if friend is _NOT_FETCHED:
+            cached = self._ai_mode_cache.get(user_id)
+            if cached is not None:
+                checked_at, enabled = cached
+                if time.monotonic() - checked_at < self.AI_MODE_CACHE_TTL:
+                    return enabled
+            
+            try:
+                friend = await self.lstep_client.get_friend(user_id)
+            except Exception as e:
+                logger.error(f"Failed to check AI mode tag: {e}")
+                # エラー時はAIが応答する（フォールバック）
+                return True
+        
+        enabled = self.ai_mode_tag in self.lstep_client.tag_names(friend)
+        # 友だち情報を取得できなかった場合は、次のメッセージで確認し直す
+        if friend is not None:
+            self._set_ai_mode(user_id, enabled)
+        return enabled
+    
+    def _set_ai_mode(self, user_id: str, enabled: bool):
+        """AI対話モードの判定結果をキャッシュ"""
+        self._ai_mode_cache[user_id] = (time.monotonic(), enabled)
+        self._ai_mode_cache.move_to_end(user_id)
+        while len(self._ai_mode_cache) > self.AI_MODE_CACHE_SIZE:
+            self._ai_mode_cache.popitem(last=False)
     
-    async def _enrich_customer_from_lstep(self, customer: Customer) -> Customer:
-        """Lステップから顧客情報を取得して補完"""
-        if not lstep_client:
+    async def _enrich_customer_from_lstep(
+        self,
+        customer: Customer,
+        friend: Optional[Dict[str, Any]] = _NOT_FETCHED
+    ) -> Customer:
+        """
+        Lステップから顧客情報を取得して補完
+        
+        Args:
+            customer: 顧客情報
+            friend: 取得済みの友だち情報（Noneを含め、指定時は再取得しない）
+        """
+        if not self.lstep_client:
             return customer
         
         try:
-            # タグを取得
-            tags = await lstep_client.get_friend_tags(customer.user_id)
+            if friend is _NOT_FETCHED:
+                # タグとカスタムフィールドは1回の友だち情報の取得から取り出す
+                friend = await self.lstep_client.get_friend(customer.user_id)
+            if not friend:
+                return customer
+            tags = self.lstep_client.tag_names(friend)
+            custom_fields = friend.get("custom_fields") or {}
             
             if tags:
-                # 流入経路を抽出
-                source = LstepDataMapper.extract_source_from_tags(tags)
+                # 流入経路・ペルソナ・ジャンルをタグの1回の走査で抽出
+                classified = LstepDataMapper.classify(tags)
+                
+                # 流入経路
+                source = classified["source"]
                 if source and not customer.source:
                     customer.source = source
                 
-                # ペルソナを推定
-                persona = LstepDataMapper.extract_persona_from_tags(tags)
-                if persona and (customer.persona == PersonaType.UNKNOWN or customer.persona == "未特定"):
+                # ペルソナ
+                persona = classified["persona"]
+                if persona and customer.persona_str == PersonaType.UNKNOWN.value:
                     customer.persona = persona
                 
-                # ジャンルを抽出
-                genres = LstepDataMapper.extract_genres_from_tags(tags)
-                if genres:
-                    existing = set(customer.interest_genre or [])
-                    customer.interest_genre = list(existing | set(genres))
-            
-            # カスタムフィールドを取得
-            custom_fields = await lstep_client.get_custom_fields(customer.user_id)
+                # ジャンル
+                if classified["genres"]:
+                    customer.interest_genre.update(classified["genres"])
             
             if custom_fields:
                 # アンケート回答などを反映
@@ -255,47 +443,44 @@ class LineHandler:
     
     async def _sync_to_lstep(self, customer: Customer):
         """顧客情報をLステップに同期"""
-        if not lstep_client:
+        if not self.lstep_client:
             return
         
-        try:
-            # ペルソナをタグとして追加
-            persona_value = customer.persona if isinstance(customer.persona, str) else customer.persona.value
-            if persona_value and persona_value != "未特定":
-                await lstep_client.add_tag(customer.user_id, f"ペルソナ:{persona_value}")
-            
-            # 興味ジャンルをタグとして追加
-            for genre in (customer.interest_genre or []):
-                await lstep_client.add_tag(customer.user_id, f"興味:{genre}")
-                
-        except Exception as e:
-            logger.error(f"Failed to sync to Lstep: {e}")
+        tag_names = []
+        
+        # ペルソナをタグとして追加
+        persona_value = customer.persona_str
+        if persona_value and persona_value != "未特定":
+            tag_names.append(f"ペルソナ:{persona_value}")
+        
+        # 興味ジャンルをタグとして追加
+        for genre in sorted(customer.interest_genre):
+            tag_names.append(f"興味:{genre}")
+        
+        # タグの追加は互いに独立しているため同時に送る
+        results = await asyncio.gather(
+            *(self.lstep_client.add_tag(customer.user_id, tag_name) for tag_name in tag_names),
+            return_exceptions=True
+        )
+        for tag_name, result in zip(tag_names, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to sync to Lstep ({tag_name}): {result}")
     
     def _is_handoff_request(self, message: str) -> bool:
         """人間への転送リクエストを検知"""
-        handoff_keywords = [
-            "人と話したい",
-            "担当者と話したい",
-            "スタッフと話したい",
-            "人間と話したい",
-            "オペレーター",
-            "問い合わせ",
-            "クレーム",
-            "返金",
-            "解約"
-        ]
-        return any(keyword in message for keyword in handoff_keywords)
+        return _HANDOFF_MATCHER.search(message)
     
     async def _handle_handoff(self, event: MessageEvent, user_id: str, message: str):
         """人間への転送処理"""
         # Lステップに通知
-        if lstep_client:
-            await lstep_client.notify_staff(
+        if self.lstep_client:
+            await self.lstep_client.notify_staff(
                 user_id,
                 f"【人間対応リクエスト】\nユーザーメッセージ: {message}"
             )
             # AI対話モードを解除
-            await lstep_client.remove_tag(user_id, self.ai_mode_tag)
+            await self.lstep_client.remove_tag(user_id, self.ai_mode_tag)
+            self._set_ai_mode(user_id, False)
         
         # ユーザーに返信
         await self.line_bot_api.reply_message(
@@ -307,22 +492,53 @@ class LineHandler:
             )
         )
     
-    def verify_signature(self, body: str, signature: str) -> bool:
-        """署名を検証"""
-        hash_value = hmac.new(
-            self.channel_secret.encode('utf-8'),
-            body.encode('utf-8'),
-            hashlib.sha256
-        ).digest()
-        expected_signature = base64.b64encode(hash_value).decode('utf-8')
-        return hmac.compare_digest(signature, expected_signature)
+    def verify_signature(self, body: bytes, signature: str) -> bool:
+        """署名を検証（bodyはリクエストボディのバイト列）"""
+        try:
+            # 計算したダイジェストをエンコードせず、署名の方をデコードして比べる
+            received = base64.b64decode(signature, validate=True)
+        except ValueError:
+            return False
+        mac = self._hmac_template.copy()
+        mac.update(body)
+        return hmac.compare_digest(received, mac.digest())
     
-    async def handle_webhook(self, body: str, signature: str):
-        """Webhookを処理"""
+    def handle_webhook(self, body: bytes, signature: str):
+        """
+        Webhookを受け付ける
+        
+        署名の検証とイベントの解析だけをその場で行い、イベントの処理（AI応答の生成など）は
+        バックグラウンドで行う（LINEへの応答を処理の完了まで待たせない）
+        署名の検証もJSONの解析もリクエストボディのバイト列のまま行う
+        （SDKのWebhookParserは文字列を受け取り、署名も検証し直すため使わない）
+        """
         if not self.verify_signature(body, signature):
             raise InvalidSignatureError("Invalid signature")
         
-        self.handler.handle(body, signature)
+        events = self._parse_events(body)
+        if events:
+            self._run_in_background(self._process_events(events))
+    
+    @staticmethod
+    def _parse_events(body: bytes) -> List[Event]:
+        """イベントを解析（SDKが知らない種類のイベントは読み飛ばし、他のイベントは処理する）"""
+        events = []
+        for obj in orjson.loads(body).get("events", []):
+            try:
+                events.append(Event.from_dict(obj))
+            except ValueError as e:
+                logger.warning("Skipping unknown webhook event (type=%s): %s", obj.get("type"), e)
+        return events
+    
+    async def _process_events(self, events: List[Event]):
+        """Webhookのイベントを処理（別々のユーザーのイベントは同時に、同じユーザーのイベントは順番に処理する）"""
+        events_by_user: Dict[Optional[str], List[Event]] = defaultdict(list)
+        for event in events:
+            events_by_user[getattr(event.source, "user_id", None)].append(event)
+        await asyncio.gather(*(
+            self._dispatch_in_order(user_id, user_events)
+            for user_id, user_events in events_by_user.items()
+        ))
 
 
 # グローバルインスタンス（初期化は後で行う）
@@ -332,13 +548,17 @@ line_handler: Optional[LineHandler] = None
 def initialize_line_handler(
     channel_access_token: str, 
     channel_secret: str,
-    ai_mode_tag: str = "AI対話モード"
+    ai_mode_tag: str = "AI対話モード",
+    ai_engine: Optional[AIEngine] = None,
+    lstep_client: Optional[LstepClient] = None
 ):
     """LINE Handlerを初期化"""
     global line_handler
     line_handler = LineHandler(
         channel_access_token=channel_access_token,
         channel_secret=channel_secret,
-        ai_mode_tag=ai_mode_tag
+        ai_mode_tag=ai_mode_tag,
+        ai_engine=ai_engine,
+        lstep_client=lstep_client
     )
     return line_handler
@@ -2,10 +2,14 @@
 Lステップ API クライアント
 Lステップとの連携機能を提供
 """
+import asyncio
+import time
 import httpx
-from typing import Optional, Dict, Any, List
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime
 import logging
+from app.keyword_matcher import KeywordMatcher
 
 logger = logging.getLogger(__name__)
 
@@ -16,11 +20,25 @@ class LstepClient:
     # Lステップ API エンドポイント
     BASE_URL = "https://api.linestep.jp/v1"
     
-    def __init__(self, api_key: str, account_id: str):
+    # コネクションプール設定
+    MAX_CONNECTIONS = 100
+    MAX_KEEPALIVE_CONNECTIONS = 50
+    
+    # 友だち情報のキャッシュ（秒・件数）
+    FRIEND_CACHE_TTL = 30.0
+    FRIEND_CACHE_SIZE = 1024
+    
+    def __init__(
+        self,
+        api_key: str,
+        account_id: str,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
         """
         Args:
             api_key: Lステップ APIキー
             account_id: Lステップ アカウントID
+            transport: HTTPトランスポート（テストでモックに差し替える場合のみ指定）
         """
         self.api_key = api_key
         self.account_id = account_id
@@ -28,10 +46,36 @@ class LstepClient:
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        # 1回のWebhookで複数回呼ばれるため、TCP/TLS接続を使い回す
+        self._client = httpx.AsyncClient(
+            base_url=self.BASE_URL,
+            headers=self.headers,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=self.MAX_CONNECTIONS,
+                max_keepalive_connections=self.MAX_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=10.0,
+            transport=transport
+        )
+        
+        # 友だち情報のTTL付きLRUキャッシュ（user_id → (取得時刻, 友だち情報)）
+        self._friend_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # 同じユーザーへの同時リクエストは1本にまとめる
+        self._friend_requests: Dict[str, asyncio.Task] = {}
+    
+    def invalidate(self, line_user_id: str):
+        """友だち情報のキャッシュを破棄（取得中のリクエストの結果もキャッシュしない）"""
+        self._friend_cache.pop(line_user_id, None)
+        self._friend_requests.pop(line_user_id, None)
+    
+    async def aclose(self):
+        """HTTPクライアントを閉じる"""
+        await self._client.aclose()
     
     async def get_friend(self, line_user_id: str) -> Optional[Dict[str, Any]]:
         """
-        友だち情報を取得
+        友だち情報を取得（FRIEND_CACHE_TTL秒以内の取得結果は再利用）
         
         Args:
             line_user_id: LINE ユーザーID
@@ -39,23 +83,58 @@ class LstepClient:
         Returns:
             友だち情報（名前、タグ、カスタムフィールドなど）
         """
+        cached = self._friend_cache.get(line_user_id)
+        if cached is not None:
+            fetched_at, friend = cached
+            if time.monotonic() - fetched_at < self.FRIEND_CACHE_TTL:
+                self._friend_cache.move_to_end(line_user_id)
+                return friend
+            del self._friend_cache[line_user_id]
+        
+        task = self._friend_requests.get(line_user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_friend(line_user_id))
+            self._friend_requests[line_user_id] = task
+            task.add_done_callback(lambda done: self._forget_request(line_user_id, done))
+        return await asyncio.shield(task)
+    
+    def _forget_request(self, line_user_id: str, task: asyncio.Task):
+        """完了したリクエストを同時リクエストの登録から外す"""
+        if self._friend_requests.get(line_user_id) is task:
+            del self._friend_requests[line_user_id]
+    
+    async def _fetch_friend(self, line_user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        友だち情報をAPIから取得し、成功した場合はキャッシュする
+        
+        取得中にinvalidateされた場合は、書き込み前の情報の可能性があるためキャッシュしない
+        """
+        task = asyncio.current_task()
+        started_at = time.monotonic()
+        friend = await self._request_friend(line_user_id)
+        if friend is not None and self._friend_requests.get(line_user_id) is task:
+            self._friend_cache[line_user_id] = (started_at, friend)
+            self._friend_cache.move_to_end(line_user_id)
+            while len(self._friend_cache) > self.FRIEND_CACHE_SIZE:
+                self._friend_cache.popitem(last=False)
+        return friend
+    
+    async def _request_friend(self, line_user_id: str) -> Optional[Dict[str, Any]]:
+        """友だち情報を取得するAPIリクエスト"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.BASE_URL}/accounts/{self.account_id}/friends/{line_user_id}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
+            response = await self._client.get(
+                f"/accounts/{self.account_id}/friends/{line_user_id}"
+            )
+            
+            if response.status_code == 200:
+                return response.json()
+            elif response.status_code == 404:
+                logger.info(f"Friend not found in Lstep: {line_user_id}")
+                return None
+            else:
+                logger.error(f"Lstep API error: {response.status_code} - {response.text}")
+                return None
                 
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 404:
-                    logger.info(f"Friend not found in Lstep: {line_user_id}")
-                    return None
-                else:
-                    logger.error(f"Lstep API error: {response.status_code} - {response.text}")
-                    return None
-                    
         except Exception as e:
             logger.error(f"Lstep API request failed: {e}")
             return None
@@ -70,7 +149,11 @@ class LstepClient:
         Returns:
             タグ名のリスト
         """
-        friend = await self.get_friend(line_user_id)
+        return self.tag_names(await self.get_friend(line_user_id))
+    
+    @staticmethod
+    def tag_names(friend: Optional[Dict[str, Any]]) -> List[str]:
+        """友だち情報からタグ名のリストを取り出す"""
         if friend and "tags" in friend:
             return [tag["name"] for tag in friend["tags"]]
         return []
@@ -87,21 +170,19 @@ class LstepClient:
             成功したかどうか
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.BASE_URL}/accounts/{self.account_id}/friends/{line_user_id}/tags",
-                    headers=self.headers,
-                    json={"tag_name": tag_name},
-                    timeout=10.0
-                )
+            response = await self._client.post(
+                f"/accounts/{self.account_id}/friends/{line_user_id}/tags",
+                json={"tag_name": tag_name}
+            )
+            
+            if response.status_code in [200, 201]:
+                logger.info(f"Tag added: {tag_name} to {line_user_id}")
+                self.invalidate(line_user_id)
+                return True
+            else:
+                logger.error(f"Failed to add tag: {response.status_code}")
+                return False
                 
-                if response.status_code in [200, 201]:
-                    logger.info(f"Tag added: {tag_name} to {line_user_id}")
-                    return True
-                else:
-                    logger.error(f"Failed to add tag: {response.status_code}")
-                    return False
-                    
         except Exception as e:
             logger.error(f"Lstep API request failed: {e}")
             return False
@@ -118,15 +199,15 @@ class LstepClient:
             成功したかどうか
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(
-                    f"{self.BASE_URL}/accounts/{self.account_id}/friends/{line_user_id}/tags/{tag_name}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
+            response = await self._client.delete(
+                f"/accounts/{self.account_id}/friends/{line_user_id}/tags/{tag_name}"
+            )
+            
+            if response.status_code in [200, 204]:
+                self.invalidate(line_user_id)
+                return True
+            return False
                 
-                return response.status_code in [200, 204]
-                    
         except Exception as e:
             logger.error(f"Lstep API request failed: {e}")
             return False
@@ -164,16 +245,16 @@ class LstepClient:
             成功したかどうか
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.put(
-                    f"{self.BASE_URL}/accounts/{self.account_id}/friends/{line_user_id}/custom_fields",
-                    headers=self.headers,
-                    json={field_name: value},
-                    timeout=10.0
-                )
+            response = await self._client.put(
+                f"/accounts/{self.account_id}/friends/{line_user_id}/custom_fields",
+                json={field_name: value}
+            )
+            
+            if response.status_code in [200, 201]:
+                self.invalidate(line_user_id)
+                return True
+            return False
                 
-                return response.status_code in [200, 201]
-                    
         except Exception as e:
             logger.error(f"Lstep API request failed: {e}")
             return False
@@ -190,16 +271,13 @@ class LstepClient:
             成功したかどうか
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.BASE_URL}/accounts/{self.account_id}/scenarios/{scenario_id}/trigger",
-                    headers=self.headers,
-                    json={"line_user_id": line_user_id},
-                    timeout=10.0
-                )
+            response = await self._client.post(
+                f"/accounts/{self.account_id}/scenarios/{scenario_id}/trigger",
+                json={"line_user_id": line_user_id}
+            )
+            
+            return response.status_code in [200, 201]
                 
-                return response.status_code in [200, 201]
-                    
         except Exception as e:
             logger.error(f"Lstep API request failed: {e}")
             return False
@@ -216,25 +294,31 @@ class LstepClient:
             成功したかどうか
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.BASE_URL}/accounts/{self.account_id}/notifications",
-                    headers=self.headers,
-                    json={
-                        "line_user_id": line_user_id,
-                        "message": message,
-                        "type": "handoff"
-                    },
-                    timeout=10.0
-                )
+            response = await self._client.post(
+                f"/accounts/{self.account_id}/notifications",
+                json={
+                    "line_user_id": line_user_id,
+                    "message": message,
+                    "type": "handoff"
+                }
+            )
+            
+            return response.status_code in [200, 201]
                 
-                return response.status_code in [200, 201]
-                    
         except Exception as e:
             logger.error(f"Lstep API request failed: {e}")
             return False
 
 
+def _group_tag_keywords(tables: Dict[str, Tuple[str, ...]]) -> Dict[str, Tuple[Tuple[str, int], ...]]:
+    """種類ごとのキーワード表を キーワード → ((種類, 定義順), ...) にまとめる（同じキーワードが複数の表にあってもよい）"""
+    grouped: Dict[str, List[Tuple[str, int]]] = {}
+    for kind, keywords in tables.items():
+        for i, keyword in enumerate(keywords):
+            grouped.setdefault(keyword, []).append((kind, i))
+    return {keyword: tuple(hits) for keyword, hits in grouped.items()}
+
+
 class LstepDataMapper:
     """LステップデータをAIシステム用に変換"""
     
@@ -249,6 +333,7 @@ class LstepDataMapper:
         "オーナー": "ビジネスオーナー",
         "店舗": "ビジネスオーナー",
     }
+    _PERSONA_VALUES = tuple(TAG_TO_PERSONA.values())
     
     # タグからジャンルへのマッピング
     TAG_TO_GENRE = {
@@ -261,35 +346,67 @@ class LstepDataMapper:
         "子育て": "育児",
         "ビジネス": "ビジネス",
     }
+    _GENRE_VALUES = tuple(TAG_TO_GENRE.values())
+    
+    # 流入経路を表すタグのキーワード
+    SOURCE_KEYWORDS = ("Instagram", "X", "Twitter", "Meta", "広告", "紹介")
+    
+    # ペルソナ・ジャンル・流入経路のキーワードを1つのマッチャーにまとめ、各タグを1回だけ走査する
+    _TAG_MATCHER = KeywordMatcher(_group_tag_keywords({
+        "persona": tuple(TAG_TO_PERSONA),
+        "genre": tuple(TAG_TO_GENRE),
+        "source": SOURCE_KEYWORDS,
+    }))
+    
+    @classmethod
+    def classify(cls, tags: List[str]) -> Dict[str, Any]:
+        """
+        タグからペルソナ・ジャンル・流入経路をまとめて抽出
+        
+        Returns:
+            {"persona": ペルソナ or None, "genres": ジャンルのリスト, "source": 流入経路のタグ or None}
+        """
+        persona = None
+        genres: List[str] = []
+        source = None
+        for tag in tags:
+            persona_hits = []
+            genre_hits = set()
+            is_source = False
+            for hits in cls._TAG_MATCHER.iter(tag):
+                for kind, i in hits:
+                    if kind == "persona":
+                        persona_hits.append(i)
+                    elif kind == "genre":
+                        genre_hits.add(i)
+                    else:
+                        is_source = True
+            
+            # 1つのタグに複数のキーワードが含まれる場合は定義順で先のものを優先
+            if persona is None and persona_hits:
+                persona = cls._PERSONA_VALUES[min(persona_hits)]
+            for i in sorted(genre_hits):
+                genre = cls._GENRE_VALUES[i]
+                if genre not in genres:
+                    genres.append(genre)
+            if source is None and is_source:
+                source = tag
+        return {"persona": persona, "genres": genres, "source": source}
     
     @classmethod
     def extract_persona_from_tags(cls, tags: List[str]) -> Optional[str]:
         """タグからペルソナを推定"""
-        for tag in tags:
-            for keyword, persona in cls.TAG_TO_PERSONA.items():
-                if keyword in tag:
-                    return persona
-        return None
+        return cls.classify(tags)["persona"]
     
     @classmethod
     def extract_genres_from_tags(cls, tags: List[str]) -> List[str]:
         """タグからジャンルを抽出"""
-        genres = []
-        for tag in tags:
-            for keyword, genre in cls.TAG_TO_GENRE.items():
-                if keyword in tag and genre not in genres:
-                    genres.append(genre)
-        return genres
+        return cls.classify(tags)["genres"]
     
     @classmethod
     def extract_source_from_tags(cls, tags: List[str]) -> Optional[str]:
         """タグから流入経路を抽出"""
-        source_keywords = ["Instagram", "X", "Twitter", "Meta", "広告", "紹介"]
-        for tag in tags:
-            for keyword in source_keywords:
-                if keyword in tag:
-                    return tag
-        return None
+        return cls.classify(tags)["source"]
 
 
 # グローバルインスタンス（初期化は後で行う）
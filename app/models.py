@@ -2,8 +2,8 @@
 データモデル定義
 """
 from datetime import datetime
-from typing import Optional, List
-from pydantic import BaseModel, Field
+from typing import Optional, List, Set
+from pydantic import BaseModel, Field, field_serializer
 from enum import Enum
 
 
@@ -35,8 +35,8 @@ class Customer(BaseModel):
     
     # プロファイル情報
     occupation: Optional[str] = Field(None, description="職業")
-    interest_genre: Optional[List[str]] = Field(default_factory=list, description="興味ジャンル")
-    challenges: Optional[List[str]] = Field(default_factory=list, description="課題・悩み")
+    interest_genre: Set[str] = Field(default_factory=set, description="興味ジャンル")
+    challenges: Set[str] = Field(default_factory=set, description="課題・悩み")
     goals: Optional[str] = Field(None, description="目標")
     
     # ペルソナ・ステータス
@@ -50,6 +50,17 @@ class Customer(BaseModel):
     
     class Config:
         use_enum_values = True
+    
+    @property
+    def persona_str(self) -> str:
+        """ペルソナの文字列値（use_enum_valuesの有無や検証の省略に関わらず同じ形で返す）"""
+        persona = self.persona
+        return persona.value if isinstance(persona, PersonaType) else persona
+    
+    @field_serializer("interest_genre", "challenges")
+    def _serialize_sorted(self, values: Set[str]) -> List[str]:
+        """出力時は順序を固定したリストにする"""
+        return sorted(values)
 
 
 class Message(BaseModel):
@@ -67,6 +78,7 @@ class ConversationContext(BaseModel):
     messages: List[Message] = Field(default_factory=list)
     current_topic: Optional[str] = None
     mentioned_cases: List[str] = Field(default_factory=list, description="言及済みの成功事例ID")
+    summary: Optional[str] = Field(None, description="messagesより前の会話の要約")
 
 
 class SuccessCase(BaseModel):
@@ -2,9 +2,22 @@
 ペルソナ分析モジュール
 会話内容から顧客のペルソナを推定し、プロファイルを更新する
 """
-from typing import List, Optional, Tuple
-import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from app.models import Customer, PersonaType, ConversationStatus
+from app.keyword_matcher import KeywordMatcher
+
+
+def _invert_persona_keywords(
+    persona_keywords: Dict[PersonaType, Dict[str, List[str]]],
+    field: str
+) -> Dict[str, Tuple[PersonaType, ...]]:
+    """ペルソナ → キーワード の表を キーワード → ペルソナ に反転（fieldの分類のみ）"""
+    inverted: Dict[str, List[PersonaType]] = {}
+    for persona, keywords in persona_keywords.items():
+        for keyword in keywords[field]:
+            inverted.setdefault(keyword, []).append(persona)
+    return {keyword: tuple(personas) for keyword, personas in inverted.items()}
 
 
 class PersonaAnalyzer:
@@ -33,6 +46,13 @@ class PersonaAnalyzer:
             "challenges": ["自分を変えたい", "何か始めたい", "可能性を広げたい"]
         }
     }
+    # 分類ごとの キーワード → ペルソナ 表と、キーワード自身を返すマッチャー
+    _OCCUPATION_PERSONAS = _invert_persona_keywords(PERSONA_KEYWORDS, "occupation")
+    _KEYWORD_PERSONAS = _invert_persona_keywords(PERSONA_KEYWORDS, "keywords")
+    _CHALLENGE_PERSONAS = _invert_persona_keywords(PERSONA_KEYWORDS, "challenges")
+    _OCCUPATION_PERSONA_MATCHER = KeywordMatcher({keyword: keyword for keyword in _OCCUPATION_PERSONAS})
+    _KEYWORD_PERSONA_MATCHER = KeywordMatcher({keyword: keyword for keyword in _KEYWORD_PERSONAS})
+    _CHALLENGE_PERSONA_MATCHER = KeywordMatcher({keyword: keyword for keyword in _CHALLENGE_PERSONAS})
     
     # 興味ジャンルキーワード
     GENRE_KEYWORDS = {
@@ -44,6 +64,34 @@ class PersonaAnalyzer:
         "ハンドメイド": ["ハンドメイド", "手作り", "クラフト", "アクセサリー", "DIY"],
         "ライフスタイル": ["日常", "暮らし", "インテリア", "旅行", "カフェ"]
     }
+    _GENRE_NAMES = tuple(GENRE_KEYWORDS)
+    # キーワード → ジャンルの定義順
+    _GENRE_MATCHER = KeywordMatcher({
+        keyword: i
+        for i, keywords in enumerate(GENRE_KEYWORDS.values())
+        for keyword in keywords
+    })
+    
+    # 職業の表現（先に書いたものを優先）
+    OCCUPATION_KEYWORDS = (
+        (("会社員",), "会社員"),
+        (("サラリーマン",), "会社員"),
+        (("OL",), "会社員"),
+        (("主婦", "専業主婦"), "主婦"),
+        (("主夫",), "主夫"),
+        (("パート", "アルバイト"), "パート・アルバイト"),
+        (("経営者", "社長", "オーナー"), "経営者"),
+        (("役員",), "経営者・役員"),
+        (("自営業", "個人事業"), "自営業"),
+        (("フリーランス",), "フリーランス"),
+        (("学生",), "学生"),
+    )
+    # キーワード → 上の表の位置
+    _OCCUPATION_MATCHER = KeywordMatcher({
+        keyword: i
+        for i, (keywords, _) in enumerate(OCCUPATION_KEYWORDS)
+        for keyword in keywords
+    })
     
     # 課題キーワード
     CHALLENGE_KEYWORDS = [
@@ -56,6 +104,10 @@ class PersonaAnalyzer:
         "副業", "本業以外",
         "両立", "育児", "仕事"
     ]
+    _CHALLENGE_MATCHER = KeywordMatcher({keyword: i for i, keyword in enumerate(CHALLENGE_KEYWORDS)})
+    
+    # 抽出結果をキャッシュするメッセージの最大文字数（個人情報を含みやすい長文は保持しない）
+    PROFILE_CACHE_MAX_CHARS = 20
     
     def analyze_message(self, message: str, customer: Customer) -> Customer:
         """
@@ -68,77 +120,82 @@ class PersonaAnalyzer:
         Returns:
             更新された顧客情報
         """
-        # 職業の抽出
-        occupation = self._extract_occupation(message)
+        # 前後の空白・改行だけが違うメッセージは同じキャッシュを使う（キャッシュは短文のみ）
+        message = message.strip()
+        if len(message) <= self.PROFILE_CACHE_MAX_CHARS:
+            occupation, genres, challenges = self._extract_short_profile(message)
+        else:
+            occupation, genres, challenges = self._extract_profile(message)
+        
+        # 職業
         if occupation and not customer.occupation:
             customer.occupation = occupation
         
-        # 興味ジャンルの抽出
-        genres = self._extract_genres(message)
+        # 興味ジャンル
         if genres:
-            existing = set(customer.interest_genre or [])
-            customer.interest_genre = list(existing | set(genres))
+            customer.interest_genre.update(genres)
         
-        # 課題の抽出
-        challenges = self._extract_challenges(message)
+        # 課題
         if challenges:
-            existing = set(customer.challenges or [])
-            customer.challenges = list(existing | set(challenges))
+            customer.challenges.update(challenges)
         
         # ペルソナの推定
-        if customer.persona == PersonaType.UNKNOWN or customer.persona == "未特定":
+        if customer.persona_str == PersonaType.UNKNOWN.value:
             customer.persona = self._estimate_persona(customer)
         
         return customer
     
-    def _extract_occupation(self, message: str) -> Optional[str]:
-        """メッセージから職業を抽出"""
-        message_lower = message.lower()
-        
-        # 直接的な職業表現を探す
-        patterns = [
-            (r"会社員", "会社員"),
-            (r"サラリーマン", "会社員"),
-            (r"OL", "会社員"),
-            (r"主婦|専業主婦", "主婦"),
-            (r"主夫", "主夫"),
-            (r"パート|アルバイト", "パート・アルバイト"),
-            (r"経営者|社長|オーナー", "経営者"),
-            (r"役員", "経営者・役員"),
-            (r"自営業|個人事業", "自営業"),
-            (r"フリーランス", "フリーランス"),
-            (r"学生", "学生"),
-        ]
-        
-        for pattern, occupation in patterns:
-            if re.search(pattern, message):
-                return occupation
+    @classmethod
+    @lru_cache(maxsize=4096)
+    def _extract_short_profile(
+        cls,
+        message: str
+    ) -> Tuple[Optional[str], Tuple[str, ...], Tuple[str, ...]]:
+        """
+        短文から職業・興味ジャンル・課題を抽出
         
-        return None
+        「はい」「ありがとう」など同じ短文が繰り返し届くため、メッセージ単位でキャッシュする
+        """
+        return cls._extract_profile(message)
+    
+    @classmethod
+    def _extract_profile(
+        cls,
+        message: str
+    ) -> Tuple[Optional[str], Tuple[str, ...], Tuple[str, ...]]:
+        """メッセージから職業・興味ジャンル・課題を抽出"""
+        return (
+            cls._extract_occupation(message),
+            cls._extract_genres(message),
+            cls._extract_challenges(message)
+        )
+    
+    @classmethod
+    def _extract_occupation(cls, message: str) -> Optional[str]:
+        """メッセージから職業を抽出"""
+        # 1回の走査で全表現を検出し、表の中で最も先に書かれたものを採用
+        found = min(cls._OCCUPATION_MATCHER.iter(message), default=None)
+        if found is None:
+            return None
+        return cls.OCCUPATION_KEYWORDS[found][1]
     
-    def _extract_genres(self, message: str) -> List[str]:
+    @classmethod
+    def _extract_genres(cls, message: str) -> Tuple[str, ...]:
         """メッセージから興味ジャンルを抽出"""
-        found_genres = []
+        # 1回の走査で全キーワードを検出し、ジャンルの定義順で返す
+        found = set(cls._GENRE_MATCHER.iter(message))
         message_lower = message.lower()
+        if message_lower != message:
+            found.update(cls._GENRE_MATCHER.iter(message_lower))
         
-        for genre, keywords in self.GENRE_KEYWORDS.items():
-            for keyword in keywords:
-                if keyword in message or keyword in message_lower:
-                    if genre not in found_genres:
-                        found_genres.append(genre)
-                    break
-        
-        return found_genres
+        return tuple(cls._GENRE_NAMES[i] for i in sorted(found))
     
-    def _extract_challenges(self, message: str) -> List[str]:
+    @classmethod
+    def _extract_challenges(cls, message: str) -> Tuple[str, ...]:
         """メッセージから課題を抽出"""
-        found_challenges = []
-        
-        for challenge in self.CHALLENGE_KEYWORDS:
-            if challenge in message:
-                found_challenges.append(challenge)
-        
-        return found_challenges
+        # 1回の走査で全キーワードを検出し、定義順で返す
+        found = set(cls._CHALLENGE_MATCHER.iter(message))
+        return tuple(cls.CHALLENGE_KEYWORDS[i] for i in sorted(found))
     
     def _estimate_persona(self, customer: Customer) -> PersonaType:
         """顧客情報からペルソナを推定"""
@@ -149,29 +206,29 @@ class PersonaAnalyzer:
             PersonaType.SELF_ACHIEVER: 0
         }
         
-        # 職業によるスコアリング
+        # 職業によるスコアリング（ペルソナごとに1回だけ加点）
         if customer.occupation:
-            for persona, keywords in self.PERSONA_KEYWORDS.items():
-                for occ_keyword in keywords["occupation"]:
-                    if occ_keyword in customer.occupation:
-                        scores[persona] += 5
-                        break
-        
-        # 興味ジャンルによるスコアリング
+            matched = {
+                persona
+                for keyword in self._OCCUPATION_PERSONA_MATCHER.iter(customer.occupation)
+                for persona in self._OCCUPATION_PERSONAS[keyword]
+            }
+            for persona in matched:
+                scores[persona] += 5
+        
+        # 興味ジャンルによるスコアリング（含まれるキーワードごとに加点）
         if customer.interest_genre:
-            genre_str = " ".join(customer.interest_genre)
-            for persona, keywords in self.PERSONA_KEYWORDS.items():
-                for keyword in keywords["keywords"]:
-                    if keyword in genre_str:
-                        scores[persona] += 2
+            genre_str = " ".join(sorted(customer.interest_genre))
+            for keyword in set(self._KEYWORD_PERSONA_MATCHER.iter(genre_str)):
+                for persona in self._KEYWORD_PERSONAS[keyword]:
+                    scores[persona] += 2
         
-        # 課題によるスコアリング
+        # 課題によるスコアリング（含まれるキーワードごとに加点）
         if customer.challenges:
-            challenge_str = " ".join(customer.challenges)
-            for persona, keywords in self.PERSONA_KEYWORDS.items():
-                for challenge in keywords["challenges"]:
-                    if challenge in challenge_str:
-                        scores[persona] += 3
+            challenge_str = " ".join(sorted(customer.challenges))
+            for keyword in set(self._CHALLENGE_PERSONA_MATCHER.iter(challenge_str)):
+                for persona in self._CHALLENGE_PERSONAS[keyword]:
+                    scores[persona] += 3
         
         # 最高スコアのペルソナを選択
         max_score = max(scores.values())
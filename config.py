@@ -17,6 +17,8 @@ class Settings(BaseSettings):
     # OpenAI
     openai_api_key: str = Field(..., env="OPENAI_API_KEY")
     openai_model: str = Field(default="gpt-4-turbo-preview", env="OPENAI_MODEL")
+    # 設定するとナレッジ検索にembeddingによる意味検索を併用する
+    openai_embedding_model: Optional[str] = Field(default=None, env="OPENAI_EMBEDDING_MODEL")
     
     # Lステップ連携
     lstep_api_key: Optional[str] = Field(default=None, env="LSTEP_API_KEY")
@@ -2,22 +2,36 @@
 LINE自動応答AIエージェント - メインアプリケーション
 FastAPIベースのWebhookサーバー
 """
+import asyncio
 import os
 import logging
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException, Header
+from typing import Any, List
+from fastapi import FastAPI, Request, HTTPException, Header, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
+import orjson
 from dotenv import load_dotenv
+from pydantic import TypeAdapter
+# 例外クラスは軽いため、lifespanの前から参照できるよう先に読み込む
+from linebot.v3.exceptions import InvalidSignatureError
 
 # 環境変数を読み込み
 load_dotenv()
 
 from config import get_settings
-from app.database import db
-from app.knowledge_base import knowledge_base
-from app.ai_engine import initialize_ai_engine, ai_engine
-from app.line_handler import initialize_line_handler, line_handler
-from app.lstep_client import initialize_lstep_client, lstep_client
+from app.models import Message
+
+# アプリ本体（OpenAI・LINE SDKなどを読み込むモジュール）はlifespanで読み込み、
+# 起動時に初期化したインスタンスをここに入れる（各エンドポイントは呼び出し時に参照する）
+db = None
+knowledge_base = None
+ai_engine = None
+line_handler = None
+lstep_client = None
+
+# 設定は起動後に変わらないため、読み込んだものをモジュール全体で使う
+settings = get_settings()
 
 # ロギング設定
 logging.basicConfig(
@@ -26,33 +40,62 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Webhookのリクエストボディの上限（LINEのWebhookはこれより十分小さい）
+MAX_WEBHOOK_BODY_BYTES = 64 * 1024
+
+# 管理用APIの一覧はモデルごとにmodel_dumpせず、pydanticのコアでまとめてJSON用に変換する
+_message_list_adapter = TypeAdapter(List[Message])
+
+
+class OrjsonResponse(JSONResponse):
+    """orjsonでJSONに変換するレスポンス（非推奨になったFastAPIのORJSONResponseの代わり）"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """アプリケーションのライフサイクル管理"""
+    global db, knowledge_base, ai_engine, line_handler, lstep_client
+    
     # 起動時の初期化
     logger.info("Initializing application...")
     
-    settings = get_settings()
+    from app.database import db
+    from app.knowledge_base import knowledge_base
+    from app.ai_engine import initialize_ai_engine
+    from app.line_handler import initialize_line_handler
+    from app.lstep_client import initialize_lstep_client
     
-    # データベース初期化
-    await db.initialize()
+    # データベース初期化とナレッジベース読み込み（ファイル読み込みはスレッドで行い、同時に進める）
+    await asyncio.gather(
+        db.initialize(),
+        asyncio.to_thread(knowledge_base.load)
+    )
     logger.info("Database initialized")
-    
-    # ナレッジベース読み込み
-    knowledge_base.load()
     logger.info(f"Knowledge base loaded: {len(knowledge_base.success_cases)} cases, {len(knowledge_base.faqs)} FAQs")
     
     # AIエンジン初期化
-    initialize_ai_engine(
+    engine = initialize_ai_engine(
         api_key=settings.openai_api_key,
-        model=settings.openai_model
+        model=settings.openai_model,
+        embedding_model=settings.openai_embedding_model
     )
     logger.info("AI engine initialized")
     
+    # ナレッジの意味検索（設定がある場合のみ）
+    if settings.openai_embedding_model:
+        try:
+            await engine.prepare_knowledge_embeddings()
+            logger.info(f"Knowledge embeddings prepared: {settings.openai_embedding_model}")
+        except Exception as e:
+            logger.error(f"Failed to prepare knowledge embeddings, using keyword search only: {e}")
+    
     # Lステップ連携初期化（設定がある場合のみ）
+    lstep = None
     if settings.lstep_enabled:
-        initialize_lstep_client(
+        lstep = initialize_lstep_client(
             api_key=settings.lstep_api_key,
             account_id=settings.lstep_account_id
         )
@@ -61,18 +104,26 @@ async def lifespan(app: FastAPI):
         logger.info("Lstep integration disabled (API key not configured)")
     
     # LINE Handler初期化
-    initialize_line_handler(
+    handler = initialize_line_handler(
         channel_access_token=settings.line_channel_access_token,
         channel_secret=settings.line_channel_secret,
-        ai_mode_tag=settings.lstep_ai_mode_tag
+        ai_mode_tag=settings.lstep_ai_mode_tag,
+        ai_engine=engine,
+        lstep_client=lstep
     )
     logger.info("LINE handler initialized")
     
+    ai_engine, lstep_client, line_handler = engine, lstep, handler
     logger.info("Application startup complete!")
     
     yield
     
-    # シャットダウン時のクリーンアップ
+    # シャットダウン時のクリーンアップ（処理中のイベントを済ませてから閉じる）
+    await handler.wait_background_tasks()
+    await engine.aclose()
+    if lstep:
+        await lstep.aclose()
+    await db.close()
     logger.info("Application shutdown")
 
 
@@ -81,9 +132,14 @@ app = FastAPI(
     title="LINE自動応答AIエージェント",
     description="SnsClub LINE公式アカウント用 AI自動応答システム",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # レスポンスのJSON変換はorjsonで行う
+    default_response_class=OrjsonResponse
 )
 
+# 管理用APIの一覧（日本語の多いJSON）は圧縮して返す
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 
 @app.get("/")
 async def root():
@@ -98,7 +154,6 @@ async def root():
 @app.get("/health")
 async def health_check():
     """詳細ヘルスチェック"""
-    settings = get_settings()
     return {
         "status": "healthy",
         "components": {
@@ -118,6 +173,23 @@ async def health_check():
     }
 
 
+async def read_webhook_body(request: Request) -> bytes:
+    """上限を超えるボディは読み切る前に413で打ち切る"""
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_WEBHOOK_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Request body too large")
+    
+    # Content-Lengthがない（chunked）場合も読みながら上限を確認する
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_WEBHOOK_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
 @app.post("/webhook")
 async def webhook(
     request: Request,
@@ -127,22 +199,21 @@ async def webhook(
     if not x_line_signature:
         raise HTTPException(status_code=400, detail="Missing X-Line-Signature header")
     
-    body = await request.body()
-    body_str = body.decode('utf-8')
+    body = await read_webhook_body(request)
     
-    logger.info(f"Received webhook: {body_str[:200]}...")
+    # ログには先頭部分だけをデコードする
+    logger.info(f"Received webhook: {body[:200].decode('utf-8', errors='replace')}...")
     
     try:
         if line_handler:
-            # 署名検証
-            if not line_handler.verify_signature(body_str, x_line_signature):
-                raise HTTPException(status_code=400, detail="Invalid signature")
-            
-            # Webhookを処理
-            line_handler.handler.handle(body_str, x_line_signature)
+            # 署名検証のみ行い、イベントの処理はバックグラウンドに任せてすぐに応答する
+            # （ボディはバイト列のまま渡す）
+            line_handler.handle_webhook(body, x_line_signature)
             
-        return JSONResponse(content={"status": "ok"})
+        return OrjsonResponse(content={"status": "ok"})
         
+    except InvalidSignatureError:
+        raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -154,32 +225,33 @@ async def get_customer(user_id: str):
     customer = await db.get_customer(user_id)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return customer.model_dump()
+    # 顧客情報は毎回DBから読むため、pydanticのコアで直接JSONにする
+    return Response(content=customer.model_dump_json(), media_type="application/json")
 
 
 @app.get("/api/customers/{user_id}/messages")
 async def get_customer_messages(user_id: str, limit: int = 50):
     """顧客の会話履歴を取得（管理用API）"""
     messages = await db.get_conversation_history(user_id, limit=limit)
-    return [msg.model_dump() for msg in messages]
+    return OrjsonResponse(_message_list_adapter.dump_python(messages, mode="json"))
 
 
 @app.get("/api/knowledge/cases")
 async def get_success_cases():
     """成功事例一覧を取得"""
-    return [case.model_dump() for case in knowledge_base.success_cases]
+    # ナレッジは読み込み後に変わらないため、変換済みのJSONをそのまま返す
+    return Response(content=knowledge_base.success_cases_json(), media_type="application/json")
 
 
 @app.get("/api/knowledge/faqs")
 async def get_faqs():
     """FAQ一覧を取得"""
-    return [faq.model_dump() for faq in knowledge_base.faqs]
+    return Response(content=knowledge_base.faqs_json(), media_type="application/json")
 
 
 if __name__ == "__main__":
     import uvicorn
     
-    settings = get_settings()
     uvicorn.run(
         "main:app",
         host=settings.host,
@@ -63,10 +63,12 @@ async def test_conversation():
     print("-" * 60)
     
     messages = []
+    # 次のターンで使うデータは入力を待つ間に読み込んでおく
+    mentioned_cases = asyncio.create_task(db.get_mentioned_cases(test_user_id))
     
     while True:
-        # ユーザー入力
-        user_input = input("\n👤 あなた: ").strip()
+        # ユーザー入力（入力待ちの間もイベントループを止めない）
+        user_input = (await asyncio.to_thread(input, "\n👤 あなた: ")).strip()
         
         if user_input.lower() in ['quit', 'exit', 'q']:
             print("\n👋 テストを終了します")
@@ -75,40 +77,35 @@ async def test_conversation():
         if not user_input:
             continue
         
-        # メッセージを保存
         user_msg = Message(user_id=test_user_id, role="user", content=user_input)
         messages.append(user_msg)
-        await db.save_message(user_msg)
         
         # コンテキストを構築
         context = ConversationContext(
             customer=customer,
             messages=messages,
-            mentioned_cases=await db.get_mentioned_cases(test_user_id)
+            mentioned_cases=await mentioned_cases
         )
         
         # AI応答を生成
         print("\n🔄 応答生成中...")
         response = await ai_engine.generate_response(context, user_input)
         
-        # 顧客情報を更新
+        # 顧客情報とこのやり取りのメッセージをまとめて保存
         customer = context.customer
-        await db.save_customer(customer)
-        
-        # 応答を保存
         assistant_msg = Message(user_id=test_user_id, role="assistant", content=response)
         messages.append(assistant_msg)
-        await db.save_message(assistant_msg)
+        await db.save_turn(customer, [user_msg, assistant_msg])
+        mentioned_cases = asyncio.create_task(db.get_mentioned_cases(test_user_id))
         
         print(f"\n🤖 AIアシスタント:\n{response}")
         
         # 顧客プロファイル情報を表示
         print(f"\n📊 顧客プロファイル:")
         print(f"   - 職業: {customer.occupation or '未取得'}")
-        print(f"   - 興味: {', '.join(customer.interest_genre) if customer.interest_genre else '未取得'}")
-        print(f"   - 課題: {', '.join(customer.challenges) if customer.challenges else '未取得'}")
-        persona_value = customer.persona if isinstance(customer.persona, str) else customer.persona.value
-        print(f"   - ペルソナ: {persona_value}")
+        print(f"   - 興味: {', '.join(sorted(customer.interest_genre)) if customer.interest_genre else '未取得'}")
+        print(f"   - 課題: {', '.join(sorted(customer.challenges)) if customer.challenges else '未取得'}")
+        print(f"   - ペルソナ: {customer.persona_str}")
 
 
 async def test_knowledge_search():
@@ -146,10 +143,13 @@ async def main():
                        help="テストモード: chat（会話）, knowledge（ナレッジ検索）")
     args = parser.parse_args()
     
-    if args.mode == "chat":
-        await test_conversation()
-    elif args.mode == "knowledge":
-        await test_knowledge_search()
+    try:
+        if args.mode == "chat":
+            await test_conversation()
+        elif args.mode == "knowledge":
+            await test_knowledge_search()
+    finally:
+        await db.close()
 
 
 if __name__ == "__main__":
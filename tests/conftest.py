@@ -0,0 +1,18 @@
+"""
+テスト共通の設定
+"""
+import pytest
+
+# テスト用にパスを追加
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.knowledge_base import knowledge_base
+
+
+@pytest.fixture(scope="session", autouse=True)
+def shared_knowledge_base():
+    """共有のナレッジベースはセッション（xdistではワーカー）ごとに1回だけ読み込む"""
+    knowledge_base.load()
+    return knowledge_base
@@ -4,15 +4,19 @@
 import pytest
 import asyncio
 from datetime import datetime
+import orjson
+from types import SimpleNamespace
 
 # テスト用にパスを追加
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from app.models import Customer, PersonaType, ConversationStatus
+from app.models import Customer, Message, ConversationContext, PersonaType, ConversationStatus
 from app.persona_analyzer import persona_analyzer
-from app.knowledge_base import knowledge_base
+from app.knowledge_base import knowledge_base, KnowledgeBase, SubstringIndex
+from app.ai_engine import AIEngine
+from app.keyword_matcher import KeywordMatcher
 
 
 class TestPersonaAnalyzer:
@@ -34,6 +38,12 @@ class TestPersonaAnalyzer:
         customer = persona_analyzer.analyze_message(message, self.customer)
         assert customer.occupation == "主婦"
     
+    def test_extract_occupation_priority(self):
+        """複数の職業表現がある場合は表の先の方を採用するかのテスト（出現位置は問わない）"""
+        message = "学生時代の友人に誘われて、今は会社員をしながら勉強中です。"
+        customer = persona_analyzer.analyze_message(message, self.customer)
+        assert customer.occupation == "会社員"
+    
     def test_extract_genres(self):
         """興味ジャンルの抽出テスト"""
         message = "料理が好きで、毎日お弁当を作っています。ダイエットにも興味があります。"
@@ -62,14 +72,47 @@ class TestPersonaAnalyzer:
         
         persona = persona_analyzer._estimate_persona(self.customer)
         assert persona == PersonaType.CHILD_RAISING_MOM
+    
+    def test_matchers_prebuilt(self):
+        """キーワードのマッチャーがクラス定義時に構築され、メッセージごとに作り直されないかのテスト"""
+        def matchers():
+            return {
+                name: value for name, value in vars(type(persona_analyzer)).items()
+                if name.endswith("_MATCHER")
+            }
+        
+        before = matchers()
+        assert before
+        assert all(isinstance(matcher, KeywordMatcher) for matcher in before.values())
+        
+        persona_analyzer.analyze_message("会社員で料理が好きですが、時間が無いです。", self.customer)
+        after = matchers()
+        assert all(after[name] is matcher for name, matcher in before.items())
+    
+    def test_extract_profile_cached_after_strip(self):
+        """前後の空白だけが違うメッセージは抽出結果のキャッシュを共有するかのテスト"""
+        cache = type(persona_analyzer)._extract_short_profile.__func__
+        persona_analyzer.analyze_message("フリーランスでデザインをしています", self.customer)
+        hits = cache.cache_info().hits
+        
+        customer = persona_analyzer.analyze_message("  フリーランスでデザインをしています\n", Customer(user_id="test_user_005"))
+        assert cache.cache_info().hits == hits + 1
+        assert customer.occupation == self.customer.occupation
+    
+    def test_long_message_profile_not_cached(self):
+        """長文のメッセージは抽出結果をキャッシュしないかのテスト"""
+        cache = type(persona_analyzer)._extract_short_profile.__func__
+        message = "会社員をしていて、平日は帰りが遅いので副業に使える時間があまり無いのが悩みです。"
+        assert len(message) > persona_analyzer.PROFILE_CACHE_MAX_CHARS
+        size = cache.cache_info().currsize
+        
+        customer = persona_analyzer.analyze_message(message, Customer(user_id="test_user_010"))
+        assert cache.cache_info().currsize == size
+        assert customer.occupation == "会社員"
 
 
 class TestKnowledgeBase:
-    """ナレッジベースのテスト"""
-    
-    def setup_method(self):
-        """各テスト前の初期化"""
-        knowledge_base.load()
+    """ナレッジベースのテスト（共有のナレッジベースはconftest.pyで読み込み済み）"""
     
     def test_load_success_cases(self):
         """成功事例の読み込みテスト"""
@@ -98,6 +141,12 @@ class TestKnowledgeBase:
         )
         assert len(cases) > 0
     
+    def test_search_success_cases_by_genre(self):
+        """ジャンルによる成功事例検索テスト（部分一致）"""
+        cases = knowledge_base.search_success_cases(genre="美容", limit=3)
+        assert len(cases) > 0
+        assert all("美容" in case.genre for case in cases)
+    
     def test_search_faqs_by_keyword(self):
         """キーワードによるFAQ検索テスト"""
         faqs = knowledge_base.search_faqs(
@@ -130,6 +179,93 @@ class TestKnowledgeBase:
             )
             result_ids = [case.id for case in cases]
             assert all_case_ids[0] not in result_ids
+    
+    def test_substring_index(self):
+        """部分一致インデックスのテスト"""
+        index = SubstringIndex()
+        index.add(0, "育児と両立したい")
+        index.add(1, "時間が無い")
+        index.add(1, "仕事と両立")
+        
+        assert index.search("両立") == {0, 1}
+        assert index.search("時") == {1}
+        assert index.search("育児と両立したい") == {0}
+        assert index.search("両立したくない") == set()
+        # bigramは全て含むが連続していないケース
+        assert index.search("両立と") == set()
+    
+    def test_snapshot_reload(self, tmp_path):
+        """スナップショット読み込みとJSON更新時の再構築のテスト"""
+        kb = KnowledgeBase(data_dir=str(tmp_path))
+        kb.load()
+        assert (tmp_path / KnowledgeBase.SNAPSHOT_FILE).exists()
+        
+        # スナップショットから同じ内容が復元される
+        cached = KnowledgeBase(data_dir=str(tmp_path))
+        cached.load()
+        assert [c.id for c in cached.success_cases] == [c.id for c in kb.success_cases]
+        assert len(cached.search_faqs(keywords=["料金"])) > 0
+        
+        # JSONを更新するとスナップショットは使われない
+        faq_file = tmp_path / "faq.json"
+        faq_file.write_text("[]", encoding="utf-8")
+        reloaded = KnowledgeBase(data_dir=str(tmp_path))
+        reloaded.load()
+        assert reloaded.faqs == []
+    
+    def test_load_skipped_when_sources_unchanged(self, tmp_path):
+        """読み込み済みのインスタンスはJSONが更新されるまで読み込み直さないかのテスト"""
+        kb = KnowledgeBase(data_dir=str(tmp_path))
+        kb.load()
+        faqs = kb.faqs
+        kb.load()
+        assert kb.faqs is faqs
+        
+        (tmp_path / "faq.json").write_text("[]", encoding="utf-8")
+        kb.load()
+        assert kb.faqs == []
+    
+    def test_list_json_cached_until_reload(self, tmp_path):
+        """一覧APIのJSONが読み込み直すまで使い回されるかのテスト"""
+        kb = KnowledgeBase(data_dir=str(tmp_path))
+        kb.load()
+        faqs_json = kb.faqs_json()
+        assert orjson.loads(faqs_json) == [faq.model_dump(mode="json") for faq in kb.faqs]
+        assert kb.faqs_json() is faqs_json
+        
+        (tmp_path / "faq.json").write_text("[]", encoding="utf-8")
+        kb.load()
+        assert kb.faqs_json() == b"[]"
+    
+    def test_semantic_search_fusion(self, tmp_path):
+        """埋め込みによる意味検索とキーワード検索の統合テスト"""
+        kb = KnowledgeBase(data_dir=str(tmp_path))
+        kb.load()
+        
+        # 事例ごとに直交するベクトルを割り当てる
+        texts = [kb._case_embedding_text(case) for case in kb.success_cases]
+        vectors = {
+            text: [1.0 if i == j else 0.0 for j in range(len(texts))]
+            for i, text in enumerate(texts)
+        }
+        kb.set_embeddings("test-model", vectors)
+        assert kb.has_embeddings
+        
+        # キーワードが一致しなくても、意味的に近い事例が返る
+        query = vectors[texts[3]]
+        cases = kb.search_success_cases(keywords=["該当なし"], query_embedding=query, limit=1)
+        assert [case.id for case in cases] == [kb.success_cases[3].id]
+        
+        # 除外IDは意味検索でも除外される
+        cases = kb.search_success_cases(
+            query_embedding=query,
+            exclude_ids=[kb.success_cases[3].id]
+        )
+        assert kb.success_cases[3].id not in [case.id for case in cases]
+        
+        # キャッシュから同じモデルの埋め込みを読み出せる
+        assert kb.load_embedding_cache("test-model") == vectors
+        assert kb.load_embedding_cache("other-model") == {}
 
 
 class TestConversationFlow:
@@ -156,6 +292,122 @@ class TestConversationFlow:
         customer.status = ConversationStatus.HEARING
         assert customer.status == ConversationStatus.HEARING
 
+    def test_persona_str(self):
+        """ペルソナが列挙型・文字列のどちらでも文字列値で取れるかのテスト"""
+        customer = Customer(user_id="test_user_004")
+        assert customer.persona_str == "未特定"
+
+        customer.persona = PersonaType.SIDE_WORKER
+        assert customer.persona_str == "副業ワーカー"
+
+        customer = Customer.model_construct(user_id="test_user_004", persona="子育てママ")
+        assert customer.persona_str == "子育てママ"
+
+
+class TestAIEngine:
+    """AIエンジンのテスト（API呼び出しなし）"""
+    
+    def setup_method(self):
+        """各テスト前の初期化"""
+        self.engine = AIEngine(api_key="test-key")
+    
+    def test_static_system_prompt_first(self):
+        """固定のシステムプロンプトが先頭に単独で置かれるかのテスト"""
+        context = ConversationContext(
+            customer=Customer(user_id="test_user_004", display_name="テスト花子"),
+            messages=[Message(user_id="test_user_004", role="assistant", content="こんにちは")]
+        )
+        messages = self.engine._build_messages(context, "料金はいくらですか？", "## 関連するFAQ")
+        
+        assert messages[0] == {"role": "system", "content": self.engine.system_prompt}
+        assert "テスト花子" not in messages[0]["content"]
+        assert "テスト花子" in messages[1]["content"]
+        assert messages[2] == {"role": "system", "content": "## 関連するFAQ"}
+        assert messages[-1] == {"role": "user", "content": "料金はいくらですか？"}
+    
+    def test_empty_knowledge_omitted(self):
+        """ナレッジが空の場合はsystemメッセージを追加しないかのテスト"""
+        context = ConversationContext(customer=Customer(user_id="test_user_005"))
+        messages = self.engine._build_messages(context, "はい", "")
+        
+        system_messages = [m for m in messages if m["role"] == "system"]
+        assert len(system_messages) == 2
+    
+    def test_summary_before_knowledge(self):
+        """会話要約がナレッジより前のsystemメッセージに入るかのテスト"""
+        context = ConversationContext(
+            customer=Customer(user_id="test_user_008"),
+            summary="副業に興味がある会社員"
+        )
+        messages = self.engine._build_messages(context, "料金はいくらですか？", "## 関連するFAQ")
+        
+        assert messages[2] == {"role": "system", "content": "## これまでの会話の要約\n副業に興味がある会社員"}
+        assert messages[3] == {"role": "system", "content": "## 関連するFAQ"}
+    
+    def test_response_stream_segments(self):
+        """ストリーミング応答が文末で区切られて返るかのテスト"""
+        first = "はじめまして！" * 10
+        pieces = [first[:30], first[30:], "ご質問", "ありがとうございます。"]
+        
+        async def chunks():
+            for piece in pieces:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+        
+        async def create(**kwargs):
+            assert kwargs["stream"] is True
+            return chunks()
+        
+        self.engine.client = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+        )
+        
+        async def collect():
+            context = ConversationContext(customer=Customer(user_id="test_user_010"))
+            return [segment async for segment in self.engine.generate_response_stream(context, "はい")]
+        
+        assert asyncio.run(collect()) == [first, "ご質問ありがとうございます。"]
+    
+    def test_context_prompt_reused(self):
+        """顧客情報が同じならコンテキストプロンプトを再利用するかのテスト"""
+        def build(genres):
+            customer = Customer(user_id="test_user_006", occupation="会社員", interest_genre=genres)
+            return self.engine._build_context_prompt(ConversationContext(customer=customer))
+        
+        first = build(["料理"])
+        assert build(["料理"]) is first
+        assert "料理" in first
+        assert build(["美容"]) != first
+    
+    def test_extract_keywords(self):
+        """キーワード抽出のテスト（パターン定義順で重複なし）"""
+        keywords = self.engine._extract_keywords("育児中で時間がなくて不安です。育児と両立できるか心配…")
+        assert keywords == ["時間", "育児", "不安", "できる"]
+    
+    def test_extract_keywords_none(self):
+        """キーワードを含まないメッセージのテスト"""
+        assert self.engine._extract_keywords("はい") == []
+
+    def test_relevant_knowledge_skipped_without_clues(self):
+        """キーワード・ペルソナ・課題が無い場合はナレッジを検索しないかのテスト"""
+        context = ConversationContext(customer=Customer(user_id="test_user_007"))
+        assert self.engine._get_relevant_knowledge(context, "はい") == ""
+        assert self.engine._get_relevant_knowledge(context, "本当？") == ""
+        assert "## 関連するFAQ" in self.engine._get_relevant_knowledge(context, "料金はいくらですか？")
+
+    def test_query_not_embedded_without_clues(self):
+        """手がかりが無いメッセージは埋め込みを取得しないかのテスト"""
+        embedded = []
+        
+        async def embed_query(text):
+            embedded.append(text)
+            return None
+        
+        self.engine._embed_query = embed_query
+        context = ConversationContext(customer=Customer(user_id="test_user_008"))
+        asyncio.run(self.engine._prepare_messages(context, "はい"))
+        asyncio.run(self.engine._prepare_messages(context, "料金はいくらですか？"))
+        assert embedded == ["料金はいくらですか？"]
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,168 @@
+"""
+データベースのテスト
+"""
+import asyncio
+import sqlite3
+from datetime import datetime
+import pytest
+
+# テスト用にパスを追加
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.database import Database
+from app.models import Customer, Message, PersonaType, ConversationStatus
+
+
+def run(coro):
+    """コルーチンを同期的に実行"""
+    return asyncio.run(coro)
+
+
+def run_with_db(db, scenario):
+    """データベースを初期化してシナリオを実行し、最後に閉じる"""
+    async def wrapper():
+        await db.initialize()
+        try:
+            return await scenario()
+        finally:
+            await db.close()
+    return run(wrapper())
+
+
+@pytest.fixture
+def db(tmp_path):
+    """テスト用のファイルを使うデータベース"""
+    return Database(db_path=str(tmp_path / "test.db"))
+
+
+class TestDatabase:
+    """データベース操作のテスト"""
+    
+    def test_customer_roundtrip(self, db):
+        """顧客情報の保存・取得テスト"""
+        async def scenario():
+            customer = Customer(
+                user_id="test_user_101",
+                display_name="テスト太郎",
+                occupation="会社員",
+                interest_genre=["料理"],
+                challenges=["時間が無い"],
+                persona=PersonaType.SIDE_WORKER,
+                status=ConversationStatus.HEARING
+            )
+            await db.save_customer(customer)
+            return await db.get_customer("test_user_101")
+        
+        loaded = run_with_db(db, scenario)
+        assert loaded.display_name == "テスト太郎"
+        assert loaded.interest_genre == {"料理"}
+        assert loaded.challenges == {"時間が無い"}
+        assert loaded.persona == PersonaType.SIDE_WORKER
+        assert loaded.status == ConversationStatus.HEARING
+    
+    def test_conversation_history_order(self, db):
+        """会話履歴が古い順・件数制限付きで返るかのテスト"""
+        async def scenario():
+            for i in range(5):
+                await db.save_message(Message(
+                    user_id="test_user_102",
+                    role="user" if i % 2 == 0 else "assistant",
+                    content=f"message {i}"
+                ))
+            return await db.get_conversation_history("test_user_102", limit=3)
+        
+        messages = run_with_db(db, scenario)
+        assert [m.content for m in messages] == ["message 2", "message 3", "message 4"]
+    
+    def test_mentioned_cases(self, db):
+        """言及済み事例の記録テスト"""
+        async def scenario():
+            await db.add_mentioned_case("test_user_103", "case_001")
+            await db.add_mentioned_case("test_user_103", "case_003")
+            return await db.get_conversation_context("test_user_103")
+        
+        context = run_with_db(db, scenario)
+        assert context.mentioned_cases == ["case_001", "case_003"]
+        assert context.customer.user_id == "test_user_103"
+    
+    def test_summary_replaces_summarized_messages(self, db):
+        """要約済みのメッセージがコンテキストから除かれ、要約が付くかのテスト"""
+        async def scenario():
+            for i in range(4):
+                await db.save_message(Message(
+                    user_id="test_user_104",
+                    role="user" if i % 2 == 0 else "assistant",
+                    content=f"message {i}"
+                ))
+            history = await db.get_conversation_history("test_user_104")
+            await db.save_summary("test_user_104", "これまでの要約", int(history[1].id))
+            return await db.get_conversation_context("test_user_104")
+        
+        context = run_with_db(db, scenario)
+        assert context.summary == "これまでの要約"
+        assert [m.content for m in context.messages] == ["message 2", "message 3"]
+    
+    def test_background_writes_visible_to_context(self, db):
+        """バックグラウンドの書き込みが投入順に行われ、コンテキスト取得時に反映されているかのテスト"""
+        async def scenario():
+            now = datetime.now()
+            for i in range(3):
+                db.submit_write("test_user_105", db.save_message, Message(
+                    user_id="test_user_105",
+                    role="user" if i % 2 == 0 else "assistant",
+                    content=f"message {i}",
+                    timestamp=now
+                ))
+            return await db.get_conversation_context("test_user_105")
+        
+        context = run_with_db(db, scenario)
+        assert [m.content for m in context.messages] == ["message 0", "message 1", "message 2"]
+    
+    def test_read_connections_are_read_only(self, db):
+        """読み込み用コネクションでは書き込みできず、書き込み用コネクションの内容は読めるかのテスト"""
+        async def scenario():
+            await db.save_customer(Customer(user_id="test_user_106"))
+            connection = await db._read_conn()
+            with pytest.raises(sqlite3.OperationalError):
+                await connection.execute("DELETE FROM customers")
+            return await db.get_customer("test_user_106")
+        
+        customer = run_with_db(db, scenario)
+        assert customer.user_id == "test_user_106"
+    
+    def test_save_turn(self, db):
+        """顧客情報とメッセージをまとめて保存できるかのテスト"""
+        async def scenario():
+            customer = Customer(user_id="test_user_107", occupation="主婦")
+            await db.save_turn(customer, [
+                Message(user_id="test_user_107", role="user", content="こんにちは"),
+                Message(user_id="test_user_107", role="assistant", content="こんにちは！")
+            ])
+            return await db.get_conversation_context("test_user_107")
+        
+        context = run_with_db(db, scenario)
+        assert context.customer.occupation == "主婦"
+        assert [m.role for m in context.messages] == ["user", "assistant"]
+    
+    def test_flush_writes_waits_only_for_user(self, db):
+        """書き込みの完了待ちが同じワーカーの他のユーザーの書き込みを待たないかのテスト"""
+        async def scenario():
+            db.WRITE_WORKERS = 1
+            release = asyncio.Event()
+            
+            async def slow_write():
+                await release.wait()
+            
+            db.submit_write("test_user_108", slow_write)
+            # 書き込みのないユーザーはすぐに返る
+            await asyncio.wait_for(db.flush_writes("test_user_109"), timeout=1.0)
+            pending = "test_user_108" in db._pending_writes
+            release.set()
+            await db.flush_writes("test_user_108")
+            return pending, dict(db._pending_writes)
+        
+        pending, remaining = run_with_db(db, scenario)
+        assert pending
+        assert remaining == {}
@@ -0,0 +1,406 @@
+"""
+LINE Webhook ハンドラーのテスト
+"""
+import pytest
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from types import SimpleNamespace
+import orjson
+from fastapi.testclient import TestClient
+
+# テスト用にパスを追加
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# mainの読み込み時に設定を読むため、必須の設定を先に用意する
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import main
+import app.ai_engine as ai_engine_module
+import app.lstep_client as lstep_client_module
+import app.line_handler as line_handler_module
+from linebot.v3.webhooks import Event
+
+from app.database import Database
+from app.models import Message
+from app.ai_engine import initialize_ai_engine
+from app.lstep_client import LstepClient, initialize_lstep_client
+from app.line_handler import LineHandler, initialize_line_handler
+
+
+def run(coro):
+    """コルーチンを同期的に実行"""
+    return asyncio.run(coro)
+
+
+class StubMessagingApi:
+    """返信・プッシュを記録するAsyncMessagingApiの代わり"""
+
+    def __init__(self):
+        self.replies = []
+        self.pushes = []
+
+    async def get_profile(self, user_id):
+        return SimpleNamespace(display_name="テストユーザー")
+
+    async def reply_message(self, request):
+        self.replies.append([message.text for message in request.messages])
+
+    async def push_message(self, request):
+        self.pushes.append([message.text for message in request.messages])
+
+
+class StubLstepClient:
+    """API呼び出しを記録するLstepClientの代わり"""
+
+    tag_names = staticmethod(LstepClient.tag_names)
+
+    def __init__(self, friend=None):
+        self.friend = friend
+        self.calls = []
+
+    async def get_friend(self, line_user_id):
+        self.calls.append("get_friend")
+        return self.friend
+
+    async def add_tag(self, line_user_id, tag_name):
+        self.calls.append("add_tag")
+        return True
+
+    async def remove_tag(self, line_user_id, tag_name):
+        self.calls.append("remove_tag")
+        return True
+
+    async def notify_staff(self, line_user_id, message):
+        self.calls.append("notify_staff")
+        return True
+
+
+class StubAIEngine:
+    """決まった応答を返すAIEngineの代わり"""
+
+    SUMMARY_INTERVAL = 8
+    SUMMARY_KEEP_MESSAGES = 2
+
+    async def generate_welcome_message(self, customer):
+        return "友だち追加ありがとうございます！"
+
+    async def generate_response_stream(self, context, user_message):
+        yield "ご質問ありがとうございます。\n\n"
+        yield "詳しくご説明しますね。"
+
+    def needs_summary(self, messages):
+        return False
+
+
+async def make_handler(**kwargs):
+    """LINE APIの代わりにStubMessagingApiを使うハンドラーを作成"""
+    handler = LineHandler("test-token", "test-secret", **kwargs)
+    await handler.api_client.close()
+    handler.line_bot_api = StubMessagingApi()
+    return handler
+
+
+def make_event(user_id, event_type, **fields):
+    """Webhookのイベントを作成"""
+    return Event.from_dict({
+        "type": event_type,
+        "mode": "active",
+        "timestamp": 1700000000000,
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": f"event_{user_id}_{event_type}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"reply_{user_id}",
+        **fields
+    })
+
+
+def follow_event(user_id):
+    """友だち追加イベントを作成"""
+    return make_event(user_id, "follow", follow={"isUnblocked": False})
+
+
+def text_event(user_id, text):
+    """テキストメッセージイベントを作成"""
+    return make_event(user_id, "message", message={"type": "text", "id": "1", "text": text, "quoteToken": "q"})
+
+
+def sign(body, secret="test-secret"):
+    """Webhookのリクエストボディに署名する"""
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("utf-8")
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """ハンドラーが使うデータベースをテスト用のファイルに差し替える"""
+    database = Database(db_path=str(tmp_path / "test.db"))
+    monkeypatch.setattr(line_handler_module, "db", database)
+    return database
+
+
+class TestInitialize:
+    """初期化のテスト"""
+
+    def test_handler_sees_initialized_clients(self, monkeypatch):
+        """initialize_*で作ったAIエンジン・Lステップ連携をハンドラーが参照するかのテスト"""
+        monkeypatch.setattr(ai_engine_module, "ai_engine", None)
+        monkeypatch.setattr(lstep_client_module, "lstep_client", None)
+        monkeypatch.setattr(line_handler_module, "line_handler", None)
+
+        async def scenario():
+            engine = initialize_ai_engine(api_key="test-key")
+            lstep = initialize_lstep_client(api_key="test-key", account_id="test-account")
+            handler = initialize_line_handler("test-token", "test-secret")
+            try:
+                return engine, lstep, handler
+            finally:
+                await handler.api_client.close()
+                await lstep.aclose()
+                await engine.aclose()
+
+        engine, lstep, handler = run(scenario())
+        assert handler.ai_engine is engine
+        assert handler.lstep_client is lstep
+        assert line_handler_module.line_handler is handler
+
+
+class TestEventOrdering:
+    """イベント処理の順序のテスト"""
+
+    def test_same_user_serialized_across_webhooks(self):
+        """別々のWebhookで届いた同じユーザーのイベントが重ならず届いた順に処理されるかのテスト"""
+        log = []
+
+        async def scenario():
+            handler = LineHandler("test-token", "test-secret")
+
+            async def dispatch(event):
+                log.append(("start", event.name))
+                await asyncio.sleep(0.01)
+                log.append(("end", event.name))
+
+            handler._dispatch = dispatch
+            try:
+                await asyncio.gather(*(
+                    handler._process_events([SimpleNamespace(name=name, source=SimpleNamespace(user_id="test_user_301"))])
+                    for name in ("first", "second")
+                ))
+                return handler
+            finally:
+                await handler.api_client.close()
+
+        handler = run(scenario())
+        assert log == [("start", "first"), ("end", "first"), ("start", "second"), ("end", "second")]
+        # 使い終わったロックは残らない
+        assert handler._user_locks == {}
+
+
+class TestLstepLookups:
+    """Lステップの友だち情報の取得回数のテスト"""
+
+    def test_follow_fetches_missing_friend_once(self, temp_db):
+        """友だち情報がない場合も友だち追加の処理で取得が1回で済むかのテスト"""
+        lstep = StubLstepClient(friend=None)
+
+        async def scenario():
+            await temp_db.initialize()
+            handler = await make_handler(lstep_client=lstep)
+            try:
+                await handler._process_events([follow_event("test_user_302")])
+                return handler
+            finally:
+                await temp_db.close()
+
+        handler = run(scenario())
+        assert lstep.calls == ["get_friend"]
+        # AI対話モードのタグがないためウェルカムメッセージは送らない
+        assert handler.line_bot_api.replies == []
+
+
+class TestEventHandling:
+    """イベントごとの処理のテスト"""
+
+    def test_follow_then_text(self, temp_db):
+        """友だち追加でウェルカムメッセージを返信し、テキストには最初のまとまりを返信・残りをプッシュするかのテスト"""
+        async def scenario():
+            await temp_db.initialize()
+            handler = await make_handler(ai_engine=StubAIEngine())
+            try:
+                await handler._process_events([
+                    follow_event("test_user_303"),
+                    text_event("test_user_303", "副業について教えてください")
+                ])
+                await handler.wait_background_tasks()
+                await temp_db.flush_writes("test_user_303")
+                return handler, await temp_db.get_conversation_history("test_user_303")
+            finally:
+                await temp_db.close()
+
+        handler, messages = run(scenario())
+        assert handler.line_bot_api.replies == [
+            ["友だち追加ありがとうございます！"],
+            ["ご質問ありがとうございます。"]
+        ]
+        assert handler.line_bot_api.pushes == [["詳しくご説明しますね。"]]
+        assert [m.role for m in messages] == ["assistant", "user", "assistant"]
+        assert messages[1].content == "副業について教えてください"
+
+    def test_empty_response_not_saved(self, temp_db):
+        """応答が空の場合はユーザーメッセージだけを保存するかのテスト"""
+        class EmptyAIEngine(StubAIEngine):
+            async def generate_response_stream(self, context, user_message):
+                return
+                yield
+
+        async def scenario():
+            await temp_db.initialize()
+            handler = await make_handler(ai_engine=EmptyAIEngine())
+            try:
+                await handler._process_events([text_event("test_user_307", "こんにちは")])
+                await handler.wait_background_tasks()
+                await temp_db.flush_writes("test_user_307")
+                return handler, await temp_db.get_conversation_history("test_user_307")
+            finally:
+                await temp_db.close()
+
+        handler, messages = run(scenario())
+        assert handler.line_bot_api.replies == []
+        assert [(m.role, m.content) for m in messages] == [("user", "こんにちは")]
+
+    def test_handoff_clears_ai_mode(self, temp_db):
+        """人間への転送でスタッフに通知し、キャッシュ済みのAI対話モードを解除するかのテスト"""
+        lstep = StubLstepClient(friend={"tags": [{"name": "AI対話モード"}]})
+
+        async def scenario():
+            await temp_db.initialize()
+            handler = await make_handler(ai_engine=StubAIEngine(), lstep_client=lstep)
+            try:
+                enabled_before = await handler._should_ai_respond("test_user_304")
+                await handler._process_events([text_event("test_user_304", "担当者と話したいです")])
+                await handler.wait_background_tasks()
+                return handler, enabled_before
+            finally:
+                await temp_db.close()
+
+        handler, enabled_before = run(scenario())
+        assert enabled_before
+        assert handler._ai_mode_cache["test_user_304"][1] is False
+        assert lstep.calls == ["get_friend", "notify_staff", "remove_tag"]
+        assert len(handler.line_bot_api.replies) == 1
+
+
+
+class SummarizingAIEngine(StubAIEngine):
+    """要約に畳み込まれたメッセージを記録するAIEngineの代わり"""
+
+    def __init__(self):
+        self.folded = []
+
+    def needs_summary(self, messages):
+        return len(messages) >= self.SUMMARY_INTERVAL
+
+    async def summarize_conversation(self, summary, messages):
+        self.folded.extend(message.content for message in messages)
+        return "要約"
+
+
+class TestSummaryRefresh:
+    """会話要約の更新のテスト"""
+
+    def test_refresh_folds_all_unsummarized_messages(self, temp_db):
+        """要約されていないメッセージが2×SUMMARY_INTERVAL件を超えても、直近以外をすべて要約に畳み込むかのテスト"""
+        engine = SummarizingAIEngine()
+        count = engine.SUMMARY_INTERVAL * 2 + 5
+
+        async def scenario():
+            await temp_db.initialize()
+            handler = await make_handler(ai_engine=engine)
+            try:
+                for i in range(count):
+                    await temp_db.save_message(Message(
+                        user_id="test_user_306",
+                        role="user" if i % 2 == 0 else "assistant",
+                        content=f"message {i}"
+                    ))
+                await handler._refresh_summary("test_user_306")
+                return await temp_db.get_conversation_context("test_user_306")
+            finally:
+                await temp_db.close()
+
+        context = run(scenario())
+        keep = engine.SUMMARY_KEEP_MESSAGES
+        assert engine.folded == [f"message {i}" for i in range(count - keep)]
+        assert context.summary == "要約"
+        assert [m.content for m in context.messages] == [f"message {i}" for i in range(count - keep, count)]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """テスト用のハンドラーを使うWebhookサーバーのクライアント（lifespanは実行しない）"""
+    handler = run(make_handler())
+    monkeypatch.setattr(main, "line_handler", handler)
+    return TestClient(main.app)
+
+
+class TestWebhookEndpoint:
+    """Webhookエンドポイントのテスト"""
+
+    BODY = orjson.dumps({"destination": "test", "events": []})
+
+    def test_valid_signature(self, client):
+        """正しい署名のWebhookを受け付けるかのテスト"""
+        response = client.post("/webhook", content=self.BODY, headers={"X-Line-Signature": sign(self.BODY)})
+        assert response.status_code == 200
+        assert response.json() == {"status": "ok"}
+
+    def test_invalid_signature(self, client):
+        """別の鍵で署名されたWebhookを400で拒否するかのテスト"""
+        response = client.post("/webhook", content=self.BODY, headers={"X-Line-Signature": sign(self.BODY, "other-secret")})
+        assert response.status_code == 400
+
+    def test_malformed_signature(self, client):
+        """Base64でない署名を400で拒否するかのテスト"""
+        response = client.post("/webhook", content=self.BODY, headers={"X-Line-Signature": "not base64!"})
+        assert response.status_code == 400
+
+    def test_missing_signature(self, client):
+        """署名ヘッダーがないWebhookを400で拒否するかのテスト"""
+        response = client.post("/webhook", content=self.BODY)
+        assert response.status_code == 400
+
+    def test_unknown_event_type_skipped(self, client):
+        """未知の種類のイベントを読み飛ばし、同じWebhookの他のイベントは処理するかのテスト"""
+        events = [
+            {"type": "brandNewType", "mode": "active", "timestamp": 1700000000000},
+            {
+                "type": "message",
+                "mode": "active",
+                "timestamp": 1700000000000,
+                "source": {"type": "user", "userId": "test_user_305"},
+                "webhookEventId": "event_test_user_305",
+                "deliveryContext": {"isRedelivery": False},
+                "replyToken": "reply_test_user_305",
+                "message": {"type": "text", "id": "1", "text": "こんにちは", "quoteToken": "q"}
+            }
+        ]
+        scheduled = []
+        handler = main.line_handler
+        handler._process_events = lambda parsed: parsed
+        handler._run_in_background = scheduled.append
+        body = orjson.dumps({"destination": "test", "events": events})
+        response = client.post("/webhook", content=body, headers={"X-Line-Signature": sign(body)})
+        assert response.status_code == 200
+        assert len(scheduled) == 1
+        assert [event.source.user_id for event in scheduled[0]] == ["test_user_305"]
+
+    def test_oversize_body(self, client):
+        """上限を超えるボディを413で拒否するかのテスト"""
+        body = b"x" * (main.MAX_WEBHOOK_BODY_BYTES + 1)
+        response = client.post("/webhook", content=body, headers={"X-Line-Signature": sign(body)})
+        assert response.status_code == 413
@@ -0,0 +1,92 @@
+"""
+Lステップ API クライアントのテスト
+"""
+import asyncio
+import httpx
+
+# テスト用にパスを追加
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.lstep_client import LstepClient, LstepDataMapper
+
+
+def run(coro):
+    """コルーチンを同期的に実行"""
+    return asyncio.run(coro)
+
+
+def make_client(requests):
+    """API呼び出しを記録するモック付きクライアントを作成"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, request.url.path))
+        if request.method == "GET":
+            return httpx.Response(200, json={"tags": [{"name": "AI対話モード"}], "custom_fields": {"goals": "月5万円"}})
+        return httpx.Response(201)
+
+    return LstepClient(api_key="test-key", account_id="test-account", transport=httpx.MockTransport(handler))
+
+
+class TestLstepClient:
+    """Lステップ API クライアントのテスト"""
+
+    def test_friend_cached(self):
+        """タグとカスタムフィールドの取得が1回のAPI呼び出しで済むかのテスト"""
+        requests = []
+
+        async def scenario():
+            client = make_client(requests)
+            try:
+                tags, fields = await asyncio.gather(
+                    client.get_friend_tags("test_user_201"),
+                    client.get_custom_fields("test_user_201")
+                )
+                await client.get_friend("test_user_201")
+                return tags, fields
+            finally:
+                await client.aclose()
+
+        tags, fields = run(scenario())
+        assert tags == ["AI対話モード"]
+        assert fields == {"goals": "月5万円"}
+        assert requests == [("GET", "/v1/accounts/test-account/friends/test_user_201")]
+
+    def test_cache_invalidated_on_write(self):
+        """タグ追加後は友だち情報を取得し直すかのテスト"""
+        requests = []
+
+        async def scenario():
+            client = make_client(requests)
+            try:
+                await client.get_friend("test_user_202")
+                await client.add_tag("test_user_202", "興味:料理")
+                await client.get_friend("test_user_202")
+            finally:
+                await client.aclose()
+
+        run(scenario())
+        assert [method for method, _ in requests] == ["GET", "POST", "GET"]
+
+
+class TestLstepDataMapper:
+    """Lステップのタグ変換のテスト"""
+
+    def test_extract_persona_prefers_definition_order(self):
+        """1つのタグに複数のキーワードがある場合は定義順で先のペルソナになるかのテスト"""
+        assert LstepDataMapper.extract_persona_from_tags(["流入:広告", "店舗オーナー・会社員"]) == "副業ワーカー"
+        assert LstepDataMapper.extract_persona_from_tags(["流入:広告"]) is None
+
+    def test_extract_genres_in_tag_order(self):
+        """ジャンルがタグ順・定義順で重複なく返るかのテスト"""
+        genres = LstepDataMapper.extract_genres_from_tags(["コスメ料理", "美容", "子育てレシピ"])
+        assert genres == ["料理", "美容", "育児"]
+
+    def test_extract_source(self):
+        """流入経路タグの抽出テスト"""
+        assert LstepDataMapper.extract_source_from_tags(["AI対話モード", "Instagram広告"]) == "Instagram広告"
+
+    def test_classify(self):
+        """ペルソナとジャンルの両方に使われるキーワードを含むタグの抽出テスト"""
+        classified = LstepDataMapper.classify(["Instagram広告", "育児", "料理"])
+        assert classified == {"persona": "子育てママ", "genres": ["育児", "料理"], "source": "Instagram広告"}